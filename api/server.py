@@ -1,7 +1,6 @@
 import logging
 
 import uvicorn
-from elasticsearch import Elasticsearch
 from fastapi import FastAPI
 
 from src import (
@@ -10,11 +9,15 @@ from src import (
     dojo,
     healthcheck,
     indicators,
+    metrics,
     models,
     ui,
     runs,
+    transfers,
 )
+from src.elastic import es
 from src.settings import settings
+from src.storage import s3_storage
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +30,9 @@ api.include_router(indicators.router, tags=["Indicators"])
 api.include_router(terminal.router, prefix="/terminal", tags=["Terminal"])
 api.include_router(ui.router, prefix="/ui", tags=["Dojo UI"])
 api.include_router(data.router, tags=["Data"])
+api.include_router(transfers.router, tags=["Transfers"])
+api.include_router(metrics.router, tags=["Metrics"])
+api.add_middleware(metrics.RouteLabelMiddleware, routes=api.routes)
 
 
 def setup_elasticsearch_indexes():
@@ -155,8 +161,6 @@ def setup_elasticsearch_indexes():
         "outputfiles": {},
         "runs": {},
     }
-    es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
-
     for idx, config in indices.items():
         if not es.indices.exists(index=idx):
             logger.info(f"Creating index {idx}")
@@ -185,6 +189,11 @@ async def startup_event() -> None:
     print_debug_routes()
 
 
+@api.on_event("shutdown")
+async def shutdown_event() -> None:
+    await s3_storage.close()
+
+
 if __name__ == "__main__":
     setup_elasticsearch_indexes()
     print_debug_routes()
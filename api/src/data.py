@@ -20,7 +20,6 @@ from rq.job import Job
 from redis import Redis
 from rq.exceptions import NoSuchJobError
 from rq import job
-import boto3
 
 from src.utils import get_rawfile, put_rawfile
 from src.indicators import get_indicators, get_annotations
@@ -39,9 +38,6 @@ redis = Redis(
 )
 q = Queue(connection=redis, default_timeout=-1)
 
-# S3 OBJECT
-s3 = boto3.resource("s3")
-
 
 def get_context(uuid):
     try:
@@ -113,6 +109,7 @@ def available_job_strings():
         "Geotime Classify Job": "geotime_processors.geotime_classify",
         "Mixmasta Job": "mixmasta_processors.run_mixmasta",
         "Anomaly Detection": "tasks.anomaly_detection",
+        "Compact Dataset": "data_processors.compact_dataset",
     }
     return job_string_dict
 
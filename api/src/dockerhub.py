@@ -7,12 +7,10 @@
 import logging
 import requests
 from uuid import UUID
-from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
 
 from src.settings import settings
-
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
+from src.elastic import es
 
 logger: logging.Logger = logging.getLogger(__name__)
 
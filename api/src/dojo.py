@@ -1,25 +1,30 @@
+import asyncio
 import os
 import io
+import json
 import requests
+import tempfile
 import uuid
 
-from typing import List
+from collections import deque
+from typing import List, Optional
 
-from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import NotFoundError
 
-from fastapi import APIRouter, Response, status, Request, HTTPException
+from fastapi import APIRouter, Depends, Query, Response, status, Request, HTTPException
 from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from validation import DojoSchema
 from src.settings import settings
-from src.utils import delete_matching_records_from_model, put_rawfile, get_rawfile, stream_csv_from_data_paths, compress_stream
+from src.elastic import es
+from src.exports import etag_matches, export_artifacts, export_key, not_modified
+from src.utils import ArchiveStream, delete_matching_records_from_model, put_rawfile, get_rawfile, stream_data_paths, compress_stream, negotiate_encoding, try_parse_float, ExportFilter
 import logging
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
 
 def search_by_model(model_id):
     q = {"query": {"term": {"model_id.keyword": {"value": model_id, "boost": 1.0}}}}
@@ -543,24 +548,359 @@ def get_domains() -> List[str]:
     return domains
 
 
-@router.get("/dojo/download/csv/{index}/{obj_id}")
-def get_csv(index: str, obj_id: str, request: Request , wide_format: str = 'false'):
+# Media type of each download format, also used to negotiate the format from the Accept header
+DOWNLOAD_MEDIA_TYPES = {
+    DojoSchema.DownloadFormat.csv: "text/csv",
+    DojoSchema.DownloadFormat.parquet: "application/vnd.apache.parquet",
+    DojoSchema.DownloadFormat.arrow: "application/vnd.apache.arrow.stream",
+    DojoSchema.DownloadFormat.ndjson: "application/x-ndjson",
+}
+
+
+def negotiate_download_format(accept: str) -> DojoSchema.DownloadFormat:
+    """Pick the download format with the highest quality in an Accept header, defaulting to CSV."""
+    formats = {media_type: download_format for download_format, media_type in DOWNLOAD_MEDIA_TYPES.items()}
+    best, best_quality = DojoSchema.DownloadFormat.csv, 0.0
+    for entry in accept.split(","):
+        media_type, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                quality = try_parse_float(param[2:])
+        if media_type in formats and quality > best_quality:
+            best, best_quality = formats[media_type], quality
+    return best
+
+
+def download_filter(
+    features: Optional[List[str]] = Query(None),
+    timestamp_gte: Optional[int] = None,
+    timestamp_lte: Optional[int] = None,
+    country: Optional[List[str]] = Query(None),
+    admin1: Optional[List[str]] = Query(None),
+    admin2: Optional[List[str]] = Query(None),
+    admin3: Optional[List[str]] = Query(None),
+    bbox: Optional[str] = Query(None, description="min_lng,min_lat,max_lng,max_lat"),
+    columns: Optional[List[str]] = Query(None),
+) -> ExportFilter:
+    """Query parameters that restrict a download to matching rows and columns; see `ExportFilter`."""
+    if bbox is not None:
+        try:
+            bbox = [float(coordinate) for coordinate in bbox.split(",")]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="bbox must be min_lng,min_lat,max_lng,max_lat",
+            )
+    return ExportFilter(
+        features=features,
+        timestamp_gte=timestamp_gte,
+        timestamp_lte=timestamp_lte,
+        country=country,
+        admin1=admin1,
+        admin2=admin2,
+        admin3=admin3,
+        bbox=bbox,
+        columns=columns,
+    )
+
+
+def download(
+    index: str,
+    obj_id: str,
+    request: Request,
+    download_format: DojoSchema.DownloadFormat,
+    wide_format: str,
+    export_filter: ExportFilter,
+):
     try:
         run = es.get(index=index, id=obj_id)["_source"]
     except NotFoundError:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
-    run_status = run.get("attributes", {}).get("status", None)
+    media_type = DOWNLOAD_MEDIA_TYPES[download_format]
+    headers = {}
+    if download_format != DojoSchema.DownloadFormat.csv:
+        headers["Content-Disposition"] = f'attachment; filename="{obj_id}.{download_format.value}"'
+
+    content = stream_data_paths(run["data_paths"], download_format.value, wide_format, export_filter)
+    background = None
+    key = None
+    # Full exports of finished runs and published datasets can't change, so they are served from a stored artifact
+    finished = run.get("published") or run.get("attributes", {}).get("status") == "success"
+    if settings.EXPORT_ARTIFACTS and finished and export_filter.selects_all:
+        extension = f"{download_format.value}{'-wide' if wide_format == 'true' else ''}"
+        try:
+            key = export_key(run["data_paths"], {"format": download_format.value, "wide": wide_format == "true"})
+        except FileNotFoundError as e:
+            logger.warning(f"Not caching export of {obj_id}, missing data path: {e}")
+        if key is not None:
+            if etag_matches(request.headers.get("if-none-match"), key):
+                return not_modified(key)
+            info = export_artifacts.info(key, extension)
+            if info is not None:
+                return export_artifacts.response(key, extension, info, request, media_type, headers)
+            content, background = export_artifacts.store_while_streaming(content, key, extension)
+            headers["ETag"] = f'"{key}"'
+
+    # Parquet and Arrow output is binary and already compact, so only the text formats are compressed
+    if download_format in (DojoSchema.DownloadFormat.csv, DojoSchema.DownloadFormat.ndjson):
+        headers["Vary"] = "Accept-Encoding"
+        encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+        if encoding is not None:
+            content = compress_stream(content, encoding)
+            headers["Content-Encoding"] = encoding
+            if key is not None:
+                # Compressed on the fly with COMPRESSION_LEVELS, so the bytes differ from the stored artifact's
+                # encoding: the tag is weak, which If-Range never matches, so no range is resolved against it
+                headers["ETag"] = f'W/"{key}-{encoding}"'
+
+    return StreamingResponse(content, media_type=media_type, headers=headers, background=background)
 
-    if "deflate" in request.headers.get("accept-encoding", ""):
-        return StreamingResponse(
-            compress_stream(stream_csv_from_data_paths(run["data_paths"], wide_format)),
-            media_type="text/csv",
-            headers={'Content-Encoding': 'deflate'}
-        )
+
+@router.get("/dojo/download/csv/{index}/{obj_id}")
+def get_csv(
+    index: str,
+    obj_id: str,
+    request: Request,
+    wide_format: str = 'false',
+    export_filter: ExportFilter = Depends(download_filter),
+):
+    return download(index, obj_id, request, DojoSchema.DownloadFormat.csv, wide_format, export_filter)
+
+
+@router.get("/dojo/download/parquet/{index}/{obj_id}")
+def get_parquet(
+    index: str,
+    obj_id: str,
+    request: Request,
+    wide_format: str = 'false',
+    export_filter: ExportFilter = Depends(download_filter),
+):
+    return download(index, obj_id, request, DojoSchema.DownloadFormat.parquet, wide_format, export_filter)
+
+
+@router.get("/dojo/download/arrow/{index}/{obj_id}")
+def get_arrow(
+    index: str,
+    obj_id: str,
+    request: Request,
+    wide_format: str = 'false',
+    export_filter: ExportFilter = Depends(download_filter),
+):
+    return download(index, obj_id, request, DojoSchema.DownloadFormat.arrow, wide_format, export_filter)
+
+
+@router.get("/dojo/download/ndjson/{index}/{obj_id}")
+def get_ndjson(
+    index: str,
+    obj_id: str,
+    request: Request,
+    wide_format: str = 'false',
+    export_filter: ExportFilter = Depends(download_filter),
+):
+    return download(index, obj_id, request, DojoSchema.DownloadFormat.ndjson, wide_format, export_filter)
+
+
+@router.get("/dojo/download/{index}/{obj_id}")
+def get_download(
+    index: str,
+    obj_id: str,
+    request: Request,
+    wide_format: str = 'false',
+    export_filter: ExportFilter = Depends(download_filter),
+):
+    """Download a run or dataset in the format requested by the Accept header (CSV, parquet, Arrow IPC or NDJSON)."""
+    download_format = negotiate_download_format(request.headers.get("accept", ""))
+    return download(index, obj_id, request, download_format, wide_format, export_filter)
+
+
+def _parameters_match(run, parameter_filters):
+    """Whether every filter matches the run's parameter of that name, the way `/runs` searches match them."""
+    run_params = {param["name"]: param["value"] for param in run.get("parameters", [])}
+    for filter_key, filter_value in parameter_filters.items():
+        run_param_value = run_params.get(filter_key)
+        if type(run_param_value) == str:
+            if filter_value.lower() not in run_param_value.lower():
+                return False
+        elif run_param_value is None or filter_value != str(run_param_value):
+            return False
+    return True
+
+
+def bulk_export_runs(selection: DojoSchema.BulkRunDownload):
+    """
+    Look up the runs selected for a bulk export with a single Elasticsearch request. Returns the runs and the
+    requested run IDs that don't exist.
+    """
+    if selection.run_ids:
+        if len(selection.run_ids) > settings.BULK_EXPORT_MAX_RUNS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"At most {settings.BULK_EXPORT_MAX_RUNS} runs can be exported at once",
+            )
+        docs = es.mget(index="runs", body={"ids": selection.run_ids})["docs"]
+        runs = [doc["_source"] for doc in docs if doc.get("found")]
+        missing = [doc["_id"] for doc in docs if not doc.get("found")]
+        return runs, missing
+
+    if selection.model_id:
+        q = search_by_model(selection.model_id)
+    elif selection.model_name:
+        q = {"query": {"term": {"model_name.keyword": {"value": selection.model_name, "boost": 1.0}}}}
     else:
-        return StreamingResponse(
-            stream_csv_from_data_paths(run["data_paths"],wide_format),
-            media_type="text/csv",
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Select the runs to export with run_ids, model_id or model_name",
         )
+    if selection.parameters:
+        # Parameters are an object array rather than nested documents, so Elasticsearch can only narrow the search
+        # to runs having a parameter of each name. Their values are matched below, the way `/runs` matches them.
+        q = {
+            "query": {
+                "bool": {
+                    "filter": [q["query"]] + [
+                        {"term": {"parameters.name.keyword": name}} for name in selection.parameters
+                    ]
+                }
+            }
+        }
+
+    # Every candidate is checked, so a selection matching more runs than an archive can hold is rejected rather
+    # than silently cut short
+    runs = []
+    results = es.search(index="runs", body=q, scroll="2m", size=settings.BULK_EXPORT_MAX_RUNS)
+    try:
+        while True:
+            hits = results["hits"]["hits"]
+            runs.extend(hit["_source"] for hit in hits if _parameters_match(hit["_source"], selection.parameters))
+            if len(runs) > settings.BULK_EXPORT_MAX_RUNS:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"The selection matches more than {settings.BULK_EXPORT_MAX_RUNS} runs, narrow it down "
+                           "or export them in batches of run_ids",
+                )
+            if len(hits) < settings.BULK_EXPORT_MAX_RUNS:
+                return runs, []
+            results = es.scroll(scroll_id=results["_scroll_id"], scroll="2m")
+    finally:
+        es.clear_scroll(scroll_id=results["_scroll_id"])
+
+
+async def _export_run_to_file(run, download_format: DojoSchema.DownloadFormat, wide_format: str):
+    """Export a run into a temporary file, returned rewound along with its size."""
+    if not run.get("data_paths"):
+        raise ValueError("Run has no outputs")
+    export = await run_in_threadpool(tempfile.TemporaryFile)
+    try:
+        async for chunk in stream_data_paths(run["data_paths"], download_format.value, wide_format):
+            await run_in_threadpool(export.write, chunk)
+        size = export.tell()
+        export.seek(0)
+    except BaseException:
+        export.close()
+        raise
+    return export, size
+
+
+async def _drain(chunks):
+    """Run a generator of archive bytes in the threadpool, yielding what it writes."""
+    while True:
+        chunk = await run_in_threadpool(next, chunks, None)
+        if chunk is None:
+            break
+        if chunk:
+            yield chunk
+
+
+async def stream_bulk_export(runs, missing, selection: DojoSchema.BulkRunDownload):
+    """
+    Stream an archive with a file per run and a `manifest.json` describing them. Up to BULK_EXPORT_CONCURRENCY
+    runs are exported at once into temporary files, which are added to the archive in order as they finish.
+    """
+    archive = ArchiveStream(selection.archive.value)
+    wide_format = "true" if selection.wide_format else "false"
+    # Parquet and Arrow output is already compact, so only the text formats are deflated
+    compress = selection.format in (DojoSchema.DownloadFormat.csv, DojoSchema.DownloadFormat.ndjson)
+    manifest = {
+        "format": selection.format.value,
+        "wide_format": selection.wide_format,
+        "runs": [],
+        "missing": missing,
+    }
 
+    queued = iter(runs)
+    pending = deque()
+
+    def start_next():
+        run = next(queued, None)
+        if run is not None:
+            pending.append((run, asyncio.ensure_future(_export_run_to_file(run, selection.format, wide_format))))
+
+    try:
+        for _ in range(settings.BULK_EXPORT_CONCURRENCY):
+            start_next()
+        while pending:
+            run, export_task = pending.popleft()
+            entry = {
+                "id": run["id"],
+                "model_id": run.get("model_id"),
+                "model_name": run.get("model_name"),
+                "parameters": run.get("parameters", []),
+                "file": None,
+                "size": None,
+                "error": None,
+            }
+            try:
+                export, size = await export_task
+            except Exception as e:
+                # The archive is already being sent, so a failed run is recorded in the manifest instead
+                logger.warning(f"Leaving run {run['id']} out of bulk export: {e}")
+                entry["error"] = str(e) or type(e).__name__
+            start_next()
+
+            if entry["error"] is None:
+                entry["file"] = f"{run['id']}.{selection.format.value}"
+                entry["size"] = size
+                try:
+                    async for chunk in _drain(archive.add(entry["file"], export, size, compress)):
+                        yield chunk
+                finally:
+                    export.close()
+            manifest["runs"].append(entry)
+
+        manifest_bytes = json.dumps(manifest, indent=2).encode()
+        async for chunk in _drain(archive.add("manifest.json", io.BytesIO(manifest_bytes), len(manifest_bytes), True)):
+            yield chunk
+        async for chunk in _drain(archive.close()):
+            yield chunk
+    finally:
+        for _, export_task in pending:
+            if export_task.done() and not export_task.cancelled() and export_task.exception() is None:
+                export_task.result()[0].close()
+            else:
+                export_task.cancel()
+
+
+@router.post("/dojo/download/bulk/runs")
+def bulk_download_runs(selection: DojoSchema.BulkRunDownload, request: Request):
+    """
+    Download the outputs of many runs, picked by ID or by model and parameters, as a single zip or tar archive
+    with a file per run and a `manifest.json`.
+    """
+    runs, missing = bulk_export_runs(selection)
+    headers = {"Content-Disposition": f'attachment; filename="runs.{selection.archive.value}"'}
+    content = stream_bulk_export(runs, missing, selection)
+    if selection.archive == DojoSchema.ArchiveFormat.zip:
+        media_type = "application/zip"
+    else:
+        # Zip entries are compressed individually, a tar archive as a whole
+        media_type = "application/x-tar"
+        headers["Vary"] = "Accept-Encoding"
+        encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+        if encoding is not None:
+            content = compress_stream(content, encoding)
+            headers["Content-Encoding"] = encoding
+    return StreamingResponse(content, media_type=media_type, headers=headers)
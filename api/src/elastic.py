@@ -0,0 +1,64 @@
+"""
+    The API's Elasticsearch client, shared by every module so they reuse one pool of keep-alive connections.
+
+    Every request is timed into the `dojo_elasticsearch_request_seconds` histogram, labelled by index, operation
+    and outcome, so slow queries show up in `GET /metrics`.
+"""
+import time
+
+from elasticsearch import Elasticsearch, Transport
+from elasticsearch.exceptions import ConnectionTimeout, NotFoundError
+
+from src.metrics import record_elasticsearch_request
+from src.settings import settings
+
+
+def describe_request(method, url):
+    """The index and operation (e.g. `runs`, `GET _doc`) of an Elasticsearch request, for metric labels."""
+    parts = [part for part in url.split("?")[0].split("/") if part]
+    if parts and not parts[0].startswith("_"):
+        index, parts = parts[0], [part for part in parts[1:] if part.startswith("_")]
+    else:
+        index = "-"
+    return index, f"{method} {'/'.join(parts[:2]) or '/'}"
+
+
+class TimedTransport(Transport):
+    """Transport that records the latency of every request, retries included."""
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        index, operation = describe_request(method, url)
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            response = super().perform_request(method, url, headers=headers, params=params, body=body)
+            outcome = "ok"
+            return response
+        except NotFoundError:
+            outcome = "not_found"
+            raise
+        except ConnectionTimeout:
+            outcome = "timeout"
+            raise
+        finally:
+            record_elasticsearch_request(index, operation, outcome, time.perf_counter() - start)
+
+
+def create_client() -> Elasticsearch:
+    sniff = settings.ELASTICSEARCH_SNIFF
+    return Elasticsearch(
+        [settings.ELASTICSEARCH_URL],
+        port=settings.ELASTICSEARCH_PORT,
+        transport_class=TimedTransport,
+        # Connections beyond the pool size are closed after each request, so it should cover the API's concurrency
+        maxsize=settings.ELASTICSEARCH_MAX_CONNECTIONS,
+        timeout=settings.ELASTICSEARCH_TIMEOUT,
+        max_retries=settings.ELASTICSEARCH_MAX_RETRIES,
+        retry_on_timeout=settings.ELASTICSEARCH_RETRY_ON_TIMEOUT,
+        sniff_on_start=sniff,
+        sniff_on_connection_fail=sniff,
+        sniffer_timeout=settings.ELASTICSEARCH_SNIFF_INTERVAL if sniff else None,
+    )
+
+
+es = create_client()
@@ -0,0 +1,209 @@
+"""
+    Cached export artifacts. Finished runs and published datasets never change, so the first full download in
+    each format is stored as a compressed artifact and later downloads are served straight from it.
+
+    Artifacts are keyed by a hash of the export variant and the ETags of its `data_paths`, which doubles as the
+    download's strong ETag. Exports compressed while streaming get a weak ETag instead, since their bytes depend
+    on the compression level. A small JSON sidecar records the sizes of the artifact and of the export it holds, so
+    both encodings can be served with a Content-Length and as byte ranges.
+"""
+import hashlib
+import io
+import json
+import re
+import os
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import zstandard
+from fastapi import Request, Response, status
+from fastapi.logger import logger
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+
+from src.metrics import propagate_route
+from src.settings import settings
+from src.storage import storage_url
+from src.utils import CONTENT_ENCODINGS, accepts_encoding, get_rawfile, put_rawfile, rawfile_info
+
+# Content-Encoding and file extension of each artifact codec
+ARTIFACT_CODECS = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+
+def _decompressor(codec: str):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+
+def export_key(data_paths: List[str], variant: Dict) -> str:
+    """Hash identifying an export: its variant (format, layout) and the current ETag of every data path."""
+    paths = [storage_url(path) for path in data_paths]
+    with ThreadPoolExecutor(max_workers=settings.STORAGE_LIST_CONCURRENCY) as executor:
+        etags = [info["etag"] for info in executor.map(propagate_route(rawfile_info), paths)]
+    fingerprint = json.dumps({"variant": variant, "files": list(zip(paths, etags))}, sort_keys=True)
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+
+def etag_matches(if_none_match: Optional[str], key: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        tag = tag[2:] if tag.startswith("W/") else tag
+        # Every encoding of an export shares its key, and an export's content never changes under a key
+        if tag.strip('"').split("-")[0] == key:
+            return True
+    return False
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single `bytes=` range against a representation of `size` bytes into inclusive (start, end) offsets.
+    Returns None when there is no usable range (the whole representation is sent). Raises ValueError if the range
+    can't be satisfied.
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", range_header or "")
+    if match is None or match.group(1) == match.group(2) == "":
+        # Missing, malformed or multiple ranges
+        return None
+    if match.group(1) == "":
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end or start >= size:
+        raise ValueError(f"Range {range_header} not satisfiable for {size} bytes")
+    return start, end
+
+
+class ExportArtifacts:
+    """Stores and serves the compressed artifacts under `base_url` using `codec` (`gzip` or `zstd`)."""
+
+    def __init__(self, base_url: str, codec: str) -> None:
+        self.base_url = base_url
+        self.codec = codec
+
+    def path(self, key: str, extension: str) -> str:
+        return os.path.join(self.base_url, key[:2], f"{key}.{extension}{ARTIFACT_CODECS[self.codec]}")
+
+    def info(self, key: str, extension: str) -> Optional[Dict]:
+        """
+        The artifact's sidecar: `size` of the export and `encoded_size` of the artifact, or None if it hasn't been
+        stored. The sidecar is written after the artifact, so its presence means the artifact is complete.
+        """
+        try:
+            with get_rawfile(f"{self.path(key, extension)}.json", cache=False) as sidecar:
+                return json.load(sidecar)
+        except FileNotFoundError:
+            return None
+
+    def response(self, key: str, extension: str, info: Dict, request: Request, media_type: str, headers: Dict):
+        """
+        Serve a stored artifact: as is when the client accepts its encoding and decompressed otherwise, in full or
+        as the byte range asked for with `Range` (resolved against the encoding being sent).
+        """
+        encoded = accepts_encoding(request.headers.get("accept-encoding"), self.codec)
+        etag = f'"{key}-{self.codec}"' if encoded else f'"{key}"'
+        size = info["encoded_size"] if encoded else info["size"]
+        headers = {**headers, "ETag": etag, "Vary": "Accept-Encoding", "Accept-Ranges": "bytes"}
+        if encoded:
+            headers["Content-Encoding"] = self.codec
+
+        byte_range = None
+        # A range only applies to the representation the client already has part of
+        if_range = request.headers.get("if-range")
+        if not if_range or if_range.strip() == etag:
+            try:
+                byte_range = parse_range(request.headers.get("range"), size)
+            except ValueError:
+                return Response(
+                    status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                    headers={"Content-Range": f"bytes */{size}", "ETag": etag},
+                )
+
+        start, end = byte_range or (0, size - 1)
+        headers["Content-Length"] = str(end - start + 1)
+        if byte_range is not None:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return StreamingResponse(
+            self._read(self.path(key, extension), start, end, None if encoded else _decompressor(self.codec)),
+            status_code=status.HTTP_206_PARTIAL_CONTENT if byte_range is not None else status.HTTP_200_OK,
+            media_type=media_type,
+            headers=headers,
+        )
+
+    @staticmethod
+    async def _read(artifact_path: str, start: int, end: int, decompressor):
+        """
+        Yield bytes `start`-`end` of the artifact, or of its decompressed contents when a `decompressor` is given.
+        Compressed artifacts can't be entered mid-stream, so a decompressed range is read from the beginning.
+        """
+        artifact = await run_in_threadpool(get_rawfile, artifact_path, False)
+        try:
+            if decompressor is None:
+                await run_in_threadpool(artifact.seek, start)
+            position = 0 if decompressor else start
+            while position <= end:
+                chunk = await run_in_threadpool(artifact.read, settings.EXPORT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                if decompressor is not None:
+                    chunk = await run_in_threadpool(decompressor.decompress, chunk)
+                chunk_start = position
+                position += len(chunk)
+                if position <= start:
+                    continue
+                yield chunk[max(start - chunk_start, 0):end - chunk_start + 1]
+        finally:
+            artifact.close()
+
+    def store_while_streaming(self, content, key: str, extension: str):
+        """
+        Pass `content` through unchanged while compressing a copy into a spooled file. Returns the wrapped stream
+        and a background task that stores the artifact once the whole export has been sent.
+        """
+        spool = tempfile.TemporaryFile()
+        compressor = CONTENT_ENCODINGS[self.codec](settings.EXPORT_ARTIFACT_LEVEL)
+        state = {"complete": False, "size": 0}
+
+        async def tee():
+            async for chunk in content:
+                await run_in_threadpool(lambda: spool.write(compressor.compress(chunk)))
+                state["size"] += len(chunk)
+                yield chunk
+            await run_in_threadpool(lambda: spool.write(compressor.flush()))
+            state["complete"] = True
+
+        def store():
+            try:
+                # An interrupted download leaves a partial copy, which must not be stored
+                if state["complete"]:
+                    artifact_path = self.path(key, extension)
+                    sidecar = {"size": state["size"], "encoded_size": spool.tell()}
+                    spool.seek(0)
+                    put_rawfile(artifact_path, spool)
+                    put_rawfile(f"{artifact_path}.json", io.BytesIO(json.dumps(sidecar).encode()))
+                    logger.info(f"Stored export artifact {key}.{extension}")
+            finally:
+                spool.close()
+
+        return tee(), BackgroundTask(store)
+
+
+export_artifacts = ExportArtifacts(
+    base_url=settings.EXPORT_ARTIFACT_BASE_URL or os.path.join(settings.DATASET_STORAGE_BASE_URL, "_exports"),
+    codec=settings.EXPORT_ARTIFACT_CODEC,
+)
+
+
+def not_modified(key: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": f'"{key}"'})
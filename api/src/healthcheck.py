@@ -6,7 +6,6 @@ import requests
 from typing import Any, Dict, Generator, List, Optional
 import json
 
-from elasticsearch import Elasticsearch
 from pydantic import BaseModel, Field
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
@@ -14,11 +13,10 @@ from fastapi.logger import logger
 
 from validation import IndicatorSchema
 from src.settings import settings
+from src.elastic import es
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
-
 dmc_url = settings.DMC_URL
 dmc_port = settings.DMC_PORT
 dmc_user = settings.DMC_USER
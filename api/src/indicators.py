@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 import csv
 import io
 import re
@@ -13,8 +14,8 @@ from urllib.parse import urlparse
 import json
 import pandas as pd
 
-from elasticsearch import Elasticsearch
 import pandas as pd
+from elasticsearch.exceptions import NotFoundError
 from fastapi import (
     APIRouter,
     HTTPException,
@@ -26,14 +27,27 @@ from fastapi import (
     Request,
 )
 from fastapi.logger import logger
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 from validation import IndicatorSchema, DojoSchema, MetadataSchema
 from src.settings import settings
+from src.elastic import es
 
 from src.dojo import search_and_scroll
-from src.utils import put_rawfile, get_rawfile, list_files
+from src.utils import (
+    list_files,
+    put_rawfile_deduplicated,
+    read_csv_head,
+    read_parquet_head,
+    rawfile_identity,
+    sample_csv,
+    sample_parquet,
+    REFERENCE_SUFFIX,
+)
+from src.previews import preview_cache
 from src.plugins import plugin_action
+from src.storage import open_file
 from validation.IndicatorSchema import (
     IndicatorMetadataSchema,
     QualifierOutput,
@@ -47,8 +61,6 @@ import os
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
-
 
 # For created_at times in epoch milliseconds
 def current_milli_time():
@@ -114,6 +126,35 @@ def patch_indicator(
     )
 
 
+@router.patch("/indicators/{indicator_id}/data_paths")
+def patch_data_paths(payload: IndicatorSchema.DataPathsUpdateSchema, indicator_id: str):
+    """
+    Swap processed files in a dataset's `data_paths` without touching the rest of the document. The change is applied
+    inside Elasticsearch, so paths appended by another job in the meantime are kept.
+    """
+    try:
+        response = es.update(
+            index="indicators",
+            id=indicator_id,
+            body={
+                "script": {
+                    "source": (
+                        "List paths = ctx._source.data_paths == null ? new ArrayList() : ctx._source.data_paths;"
+                        "paths.removeIf(path -> params.remove.contains(path) || params.add.contains(path));"
+                        "paths.addAll(0, params.add);"
+                        "ctx._source.data_paths = paths;"
+                    ),
+                    "params": {"add": payload.add, "remove": payload.remove},
+                }
+            },
+            retry_on_conflict=5,
+            _source=["data_paths"],
+        )
+    except NotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return {"id": indicator_id, "data_paths": response["get"]["_source"]["data_paths"]}
+
+
 @router.get(
     "/indicators/latest", response_model=List[IndicatorSchema.IndicatorsSearchSchema]
 )
@@ -350,32 +391,56 @@ def patch_annotation(payload: MetadataSchema.MetaModel, indicator_id: str):
         )
 
 
+def check_filename(filename: str) -> str:
+    """Reject a file or dataset name that would resolve outside its dataset's storage directory."""
+    if not filename or "/" in filename or "\\" in filename or ".." in filename:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid filename {filename!r}"
+        )
+    return filename
+
+
+def raw_data_filename(
+    indicator_id: str, original_filename: str, filename: Optional[str] = None, append: bool = False
+) -> str:
+    """Name under which an uploaded file is stored: `raw_data<ext>`, numbered when appending to a dataset."""
+    check_filename(indicator_id)
+    if filename is not None:
+        return check_filename(filename)
+
+    _, ext = os.path.splitext(original_filename)
+    if not append:
+        return f"raw_data{ext}"
+
+    dir_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, indicator_id)
+    # Deduplicated uploads are listed as their reference objects
+    stored_files = {
+        f[: -len(REFERENCE_SUFFIX)] if f.endswith(REFERENCE_SUFFIX) else f
+        for f in list_files(dir_path)
+    }
+    filenum = len(
+        [
+            f
+            for f in stored_files
+            if f.startswith("raw_data") and f.endswith(ext)
+        ]
+    )
+    return f"raw_data_{filenum}{ext}"
+
+
 @router.post("/indicators/{indicator_id}/upload")
-def upload_file(
+async def upload_file(
     indicator_id: str,
     file: UploadFile = File(...),
     filename: Optional[str] = None,
     append: Optional[bool] = False,
 ):
-    original_filename = file.filename
-    _, ext = os.path.splitext(original_filename)
-    dir_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, indicator_id)
-    if filename is None:
-        if append:
-            filenum = len(
-                [
-                    f
-                    for f in list_files(dir_path)
-                    if f.startswith("raw_data") and f.endswith(ext)
-                ]
-            )
-            filename = f"raw_data_{filenum}{ext}"
-        else:
-            filename = f"raw_data{ext}"
+    filename = await run_in_threadpool(raw_data_filename, indicator_id, file.filename, filename, append)
 
     # Upload file
     dest_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, indicator_id, filename)
-    put_rawfile(path=dest_path, fileobj=file.file)
+    reference = await run_in_threadpool(put_rawfile_deduplicated, path=dest_path, fileobj=file.file)
+    await preview_cache.invalidate(dest_path)
 
     return Response(
         status_code=status.HTTP_201_CREATED,
@@ -383,7 +448,14 @@ def upload_file(
             "location": f"/api/indicators/{indicator_id}",
             "content-type": "application/json",
         },
-        content=json.dumps({"id": indicator_id, "filename": filename}),
+        content=json.dumps(
+            {
+                "id": indicator_id,
+                "filename": filename,
+                "sha256": reference["sha256"],
+                "duplicate": reference["duplicate"],
+            }
+        ),
     )
 
 
@@ -416,15 +488,32 @@ def validate_date(payload: IndicatorSchema.DateValidationRequestSchema):
     }
 
 
+async def _open_preview_files(paths, read_ahead=None):
+    """Open `paths` concurrently with `open_file`, giving None for the ones that don't exist."""
+    opened = await asyncio.gather(*(open_file(path, read_ahead) for path in paths), return_exceptions=True)
+    errors = [
+        result for result in opened
+        if isinstance(result, BaseException) and not isinstance(result, FileNotFoundError)
+    ]
+    if errors:
+        for result in opened:
+            if not isinstance(result, BaseException):
+                result.close()
+        raise errors[0]
+    return [None if isinstance(result, FileNotFoundError) else result for result in opened]
+
+
 @router.post("/indicators/{indicator_id}/preview/{preview_type}")
 async def create_preview(
     indicator_id: str, preview_type: IndicatorSchema.PreviewType, filename: Optional[str] = Query(None),
-    filepath: Optional[str] = Query(None),
+    filepath: Optional[str] = Query(None), sample: bool = Query(False), seed: Optional[int] = Query(None),
 ):
     """Get preview for a dataset.
 
     Args:
         indicator_id (str): The UUID of the dataset to return a preview of.
+        sample (bool): Preview rows sampled uniformly from the whole dataset instead of its first rows.
+        seed (int): Seed of a sampled preview, to get the same sample again.
 
     Returns:
         JSON: Returns a json object containing the preview for the dataset.
@@ -452,20 +541,12 @@ async def create_preview(
                     f"{indicator_id}{file_suffix}.parquet.gzip",
                 )
 
-            file = get_rawfile(rawfile_path)
-            df = pd.read_parquet(file)
-            try:
-                strparquet_path = os.path.join(
-                    settings.DATASET_STORAGE_BASE_URL,
-                    indicator_id,
-                    f"{indicator_id}_str{file_suffix}.parquet.gzip",
-                )
-                file = get_rawfile(strparquet_path)
-                df_str = pd.read_parquet(file)
-                df = pd.concat([df, df_str])
-            except FileNotFoundError:
-                pass
-
+            strparquet_path = os.path.join(
+                settings.DATASET_STORAGE_BASE_URL,
+                indicator_id,
+                f"{indicator_id}_str{file_suffix}.parquet.gzip",
+            )
+            preview_paths = [rawfile_path, strparquet_path]
         else:
             if filepath:
                 rawfile_path = os.path.join(
@@ -475,13 +556,64 @@ async def create_preview(
                 rawfile_path = os.path.join(
                     settings.DATASET_STORAGE_BASE_URL, indicator_id, "raw_data.csv"
                 )
-            file = get_rawfile(rawfile_path)
-            df = pd.read_csv(file, delimiter=",")
+            preview_paths = [rawfile_path]
 
-        obj = json.loads(df.sort_index().reset_index(drop=True).head(100).to_json(orient="index"))
+        # Previews are cached against the current identity of the files they read, so rewritten files miss
+        identities = await asyncio.gather(
+            *(run_in_threadpool(rawfile_identity, path) for path in preview_paths)
+        )
+        cache_field = preview_cache.field(
+            [preview_type.value, settings.PREVIEW_ROWS, sample, seed], identities
+        )
+        # A sample without a seed is meant to be drawn afresh every time
+        cacheable = identities[0] is not None and (not sample or seed is not None)
+        if cacheable:
+            cached = await preview_cache.get(rawfile_path, cache_field)
+            if cached is not None:
+                return Response(content=cached, media_type="application/json")
+
+        # The files are opened concurrently through the async storage backends and parsed on the threadpool, with
+        # their remote reads made on the event loop
+        processed = preview_type == IndicatorSchema.PreviewType.processed
+        read_ahead = None if sample and not processed else settings.PREVIEW_READ_AHEAD_BYTES
+        sources = await _open_preview_files(preview_paths, read_ahead)
+        try:
+            if sources[0] is None:
+                raise FileNotFoundError(rawfile_path)
+            if sample and processed:
+                df, df_str = await run_in_threadpool(sample_parquet, sources, settings.PREVIEW_ROWS, seed)
+                if df_str is not None:
+                    df = pd.concat([df, df_str])
+            elif sample:
+                df = await run_in_threadpool(sample_csv, sources[0], settings.PREVIEW_ROWS, seed, delimiter=",")
+            elif processed:
+                # Rows are interleaved by index below, so the first PREVIEW_ROWS of the numeric and string files
+                # are enough to fill the preview
+                heads = await asyncio.gather(
+                    *(
+                        run_in_threadpool(read_parquet_head, source, settings.PREVIEW_ROWS)
+                        for source in sources
+                        if source is not None
+                    )
+                )
+                df = pd.concat(heads)
+            else:
+                df = await run_in_threadpool(read_csv_head, sources[0], settings.PREVIEW_ROWS, delimiter=",")
+        finally:
+            for source in sources:
+                if source is not None:
+                    source.close()
+
+        # A stable sort keeps each numeric row ahead of the string row with the same index, however many rows
+        # were read
+        df = df.sort_index(kind="mergesort").reset_index(drop=True).head(settings.PREVIEW_ROWS)
+        obj = json.loads(df.to_json(orient="index"))
         indexed_rows = [{"__id": key, **value} for key, value in obj.items()]
 
-        return indexed_rows
+        response = JSONResponse(content=indexed_rows)
+        if cacheable:
+            await preview_cache.set(rawfile_path, cache_field, response.body.decode())
+        return response
     except FileNotFoundError as e:
         logger.exception(e)
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
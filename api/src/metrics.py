@@ -0,0 +1,146 @@
+"""
+    Prometheus metrics for the API, exposed on `GET /metrics`.
+
+    Storage helpers report every operation through `storage_timer`, labelled by operation, backend (`file`, `s3`,
+    `http`) and the endpoint serving the request, so slow previews and exports can be traced back to storage time.
+"""
+import contextvars
+import json
+import logging
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+from starlette.routing import Match
+
+from src.settings import settings
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+STORAGE_LABELS = ["operation", "backend", "caller"]
+
+storage_seconds = Histogram(
+    "dojo_storage_operation_seconds",
+    "Latency of storage operations",
+    STORAGE_LABELS,
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+storage_bytes = Histogram(
+    "dojo_storage_operation_bytes",
+    "Bytes read or written by storage operations",
+    STORAGE_LABELS,
+    buckets=tuple(1024 * 4 ** exponent for exponent in range(13)),
+)
+
+elasticsearch_seconds = Histogram(
+    "dojo_elasticsearch_request_seconds",
+    "Latency of Elasticsearch requests",
+    ["index", "operation", "outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+# Endpoint of the request being served, as `module.function`. `run_in_threadpool` copies it into worker threads;
+# work handed to other thread pools is wrapped with `propagate_route`.
+current_route = contextvars.ContextVar("current_route", default="unknown")
+
+
+class RouteLabelMiddleware:
+    """ASGI middleware setting `current_route` to the endpoint of the route matching each request."""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] in ("http", "websocket"):
+            for route in self.routes:
+                match, _ = route.matches(scope)
+                if match == Match.FULL:
+                    endpoint = getattr(route, "endpoint", None)
+                    if endpoint is None:
+                        current_route.set(route.name)
+                    else:
+                        current_route.set(f"{endpoint.__module__.rsplit('.', 1)[-1]}.{endpoint.__name__}")
+                    break
+        await self.app(scope, receive, send)
+
+
+def propagate_route(function):
+    """Wrap `function` so that calls to it on another thread are labelled with the current request's route."""
+    context = contextvars.copy_context()
+
+    def run_in_context(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return run_in_context
+
+
+def record_storage_operation(operation, backend, seconds, size=None, caller=None):
+    caller = caller or current_route.get()
+    storage_seconds.labels(operation, backend, caller).observe(seconds)
+    if size is not None:
+        storage_bytes.labels(operation, backend, caller).observe(size)
+    if settings.STORAGE_METRICS_LOG:
+        logger.info(
+            json.dumps(
+                {
+                    "event": "storage_operation",
+                    "operation": operation,
+                    "backend": backend,
+                    "caller": caller,
+                    "seconds": round(seconds, 6),
+                    "bytes": size,
+                }
+            )
+        )
+
+
+def record_elasticsearch_request(index, operation, outcome, seconds):
+    elasticsearch_seconds.labels(index, operation, outcome).observe(seconds)
+    if settings.STORAGE_METRICS_LOG:
+        logger.info(
+            json.dumps(
+                {
+                    "event": "elasticsearch_request",
+                    "index": index,
+                    "operation": operation,
+                    "outcome": outcome,
+                    "seconds": round(seconds, 6),
+                }
+            )
+        )
+
+
+@contextmanager
+def storage_timer(operation, path):
+    """
+    Time the storage operation run inside the block. The block can set `stats["bytes"]` to record the amount of
+    data it moved.
+    """
+    caller = current_route.get()
+    backend = urlparse(path).scheme.lower() or "file"
+    stats = {"bytes": None}
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        record_storage_operation(
+            operation, backend, time.perf_counter() - start, stats["bytes"], caller
+        )
+
+
+def register_cache(name, cache):
+    """Expose the hit and miss counters of a cache object as gauges."""
+    for counter in ("hits", "misses"):
+        Gauge(
+            f"dojo_{name}_{counter}", f"Number of {name.replace('_', ' ')} {counter}"
+        ).set_function(lambda counter=counter: getattr(cache, counter))
+
+
+@router.get("/metrics")
+def get_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
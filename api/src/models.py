@@ -7,23 +7,17 @@ from copy import deepcopy
 import json
 from typing import Dict, List, Union
 
-from elasticsearch import Elasticsearch
-
 from fastapi import APIRouter, HTTPException, Query, Response, status
 from fastapi.logger import logger
 from validation import ModelSchema, DojoSchema
 
-from src.settings import settings
+from src.elastic import es
 from src.dojo import search_and_scroll, copy_configs, copy_outputfiles, copy_directive, copy_accessory_files
 from src.plugins import plugin_action
 from src.utils import run_model_with_defaults
 
 router = APIRouter()
 
-es = Elasticsearch(
-    [settings.ELASTICSEARCH_URL],
-    port=settings.ELASTICSEARCH_PORT
-)
 logger = logging.getLogger(__name__)
 
 
@@ -0,0 +1,65 @@
+"""
+    Cache of dataset previews in Redis. The annotation UI asks for the same preview many times while a dataset is
+    being annotated, so rendered previews are kept for PREVIEW_CACHE_TTL seconds.
+
+    Each file previewed gets a Redis hash keyed by its path. Its fields identify a preview variant and the current
+    identity (ETag or content hash) of every file read for it, so a rewritten file is never served from the cache
+    even when it was rewritten by a processing job. Uploads also drop the hash of the path they write.
+"""
+import json
+import logging
+from typing import List, Optional
+
+from src.metrics import register_cache
+from src.redisapi import redis_pool
+from src.settings import settings
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class PreviewCache:
+    def __init__(self, ttl: int) -> None:
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(path: str) -> str:
+        return f"preview:{path}"
+
+    @staticmethod
+    def field(variant: List, identities: List[Optional[str]]) -> str:
+        return json.dumps([variant, identities])
+
+    async def get(self, path: str, field: str) -> Optional[str]:
+        # The cache is an optimization, so previews are still served when Redis is unavailable
+        try:
+            redis = await redis_pool()
+            cached = await redis.hget(self.key(path), field)
+        except Exception as e:
+            logger.warning(f"Preview cache unavailable: {e}")
+            return None
+        if cached is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cached
+
+    async def set(self, path: str, field: str, preview: str) -> None:
+        try:
+            redis = await redis_pool()
+            await redis.hset(self.key(path), field, preview)
+            await redis.expire(self.key(path), self.ttl)
+        except Exception as e:
+            logger.warning(f"Preview cache unavailable: {e}")
+
+    async def invalidate(self, path: str) -> None:
+        try:
+            redis = await redis_pool()
+            await redis.delete(self.key(path))
+        except Exception as e:
+            logger.warning(f"Preview cache unavailable: {e}")
+
+
+preview_cache = PreviewCache(ttl=settings.PREVIEW_CACHE_TTL)
+register_cache("preview_cache", preview_cache)
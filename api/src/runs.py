@@ -11,7 +11,6 @@ from operator import itemgetter
 from threading import Thread, current_thread
 from typing import Any, Dict, Generator, List, Optional
 
-from elasticsearch import Elasticsearch
 from jinja2 import Template
 
 from fastapi import APIRouter, Depends, HTTPException, Query, Response, status, Request
@@ -32,11 +31,10 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 from src.settings import settings
+from src.elastic import es
 
 router = APIRouter()
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
-
 
 # For created_at times in epoch milliseconds
 def current_milli_time():
@@ -1,4 +1,6 @@
-from pydantic import BaseSettings, PyObject
+import re
+
+from pydantic import BaseSettings, PyObject, validator
 from typing import Dict
 from src.plugins import PluginHandler
 from fastapi.logger import logger
@@ -10,6 +12,14 @@ class Settings(BaseSettings):
     BIND_PORT: int = 8000
     ELASTICSEARCH_URL: str
     ELASTICSEARCH_PORT: int = 9200
+    # Shared client: connections kept alive to each node, request timeout in seconds, retries of failed requests
+    # and whether to discover the cluster's nodes (re-checked every ELASTICSEARCH_SNIFF_INTERVAL seconds)
+    ELASTICSEARCH_MAX_CONNECTIONS: int = 32
+    ELASTICSEARCH_TIMEOUT: float = 30
+    ELASTICSEARCH_MAX_RETRIES: int = 3
+    ELASTICSEARCH_RETRY_ON_TIMEOUT: bool = True
+    ELASTICSEARCH_SNIFF: bool = False
+    ELASTICSEARCH_SNIFF_INTERVAL: float = 60
     DMC_URL: str
     DMC_PORT: int = 8080
     DMC_USER: str
@@ -31,6 +41,69 @@ class Settings(BaseSettings):
 
     CONFIG_STORAGE_BASE: str = "file:///storage/configs/"
 
+    # Size of the read-ahead buffer used when streaming objects out of S3 with ranged GETs
+    S3_READ_AHEAD_BYTES: int = 8 * 1024 * 1024
+
+    # Shared S3 client and transfer tuning
+    S3_MAX_POOL_CONNECTIONS: int = 32
+    S3_MAX_ATTEMPTS: int = 5
+    S3_DOWNLOAD_CHUNKSIZE: int = 16 * 1024 * 1024
+    S3_DOWNLOAD_CONCURRENCY: int = 8
+
+    # Uploads are copied in chunks of this size for local storage and sent as concurrent multipart uploads to S3
+    STORAGE_COPY_CHUNKSIZE: int = 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE: int = 16 * 1024 * 1024
+    S3_MULTIPART_CONCURRENCY: int = 4
+    # Number of sub-prefixes listed in parallel by iter_files
+    STORAGE_LIST_CONCURRENCY: int = 8
+    # Log every storage operation (latency, bytes, backend and caller) and Elasticsearch request as a JSON line
+    STORAGE_METRICS_LOG: bool = False
+
+    # Local disk cache for remote dataset and run files, revalidated by ETag. Set the size to 0 to disable it.
+    STORAGE_CACHE_DIR: str = "/tmp/dojo-storage-cache"
+    STORAGE_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024
+    STORAGE_CACHE_MAX_OBJECT_BYTES: int = 512 * 1024 * 1024
+
+    # Lifetime of presigned upload/download URLs. Local storage uses tokens signed with STORAGE_SIGNING_SECRET
+    # instead, which must be the same in every API process; without it the signed-token routes are unavailable.
+    PRESIGNED_URL_EXPIRES: int = 15 * 60
+    STORAGE_SIGNING_SECRET: str = ""
+
+    # Rows in a dataset preview, and the size of the ranged reads fetching them
+    PREVIEW_ROWS: int = 100
+    PREVIEW_READ_AHEAD_BYTES: int = 256 * 1024
+    # Rows read at a time when sampling a CSV or parquet file for a preview
+    PREVIEW_SAMPLE_CHUNK_ROWS: int = 100 * 1000
+    # Seconds a rendered preview is kept in Redis
+    PREVIEW_CACHE_TTL: int = 24 * 60 * 60
+
+    # Size of the chunks CSV downloads are written and compressed in
+    EXPORT_CHUNK_SIZE: int = 64 * 1024
+    # Number of data paths read ahead concurrently during an export, and row groups buffered for each
+    EXPORT_PREFETCH_FILES: int = 4
+    EXPORT_PREFETCH_ROW_GROUPS: int = 2
+    # Rows per on-disk partition when pivoting a wide-format export; bounds its memory use
+    WIDE_EXPORT_PARTITION_ROWS: int = 1000 * 1000
+
+    # Compression level of streamed responses for each Content-Encoding (leave one out to disable it), and the number of
+    # threads compressing them
+    COMPRESSION_LEVELS: Dict[str, int] = {"zstd": 3, "br": 4, "gzip": 6, "deflate": 6}
+    COMPRESSION_WORKERS: int = 4
+
+    # Full exports of finished runs and published datasets are stored once as compressed artifacts (gzip or zstd).
+    # They live under DATASET_STORAGE_BASE_URL/_exports unless EXPORT_ARTIFACT_BASE_URL is set.
+    EXPORT_ARTIFACTS: bool = True
+    EXPORT_ARTIFACT_BASE_URL: str = ""
+    EXPORT_ARTIFACT_CODEC: str = "gzip"
+    EXPORT_ARTIFACT_LEVEL: int = 6
+
+    # Runs exported concurrently into a bulk download archive, and the most runs one archive can hold
+    BULK_EXPORT_CONCURRENCY: int = 4
+    BULK_EXPORT_MAX_RUNS: int = 500
+
+    # Maximum number of concurrent object reads/writes through the async storage backends
+    ASYNC_STORAGE_CONCURRENCY: int = 32
+
     UVICORN_RELOAD: bool = False
 
     PLUGINS: Dict[str, PyObject] = {
@@ -45,6 +118,14 @@ class Settings(BaseSettings):
         "logger": "src.plugins.logging.LoggingPlugin",
     }
 
+    @validator("STORAGE_SIGNING_SECRET")
+    def unexpanded_signing_secret(cls, secret):
+        # An envfile placeholder that was never filled in is public, so it must not become the signing key
+        if re.fullmatch(r"\$\{.*\}", secret.strip()):
+            logger.warning("STORAGE_SIGNING_SECRET is an unexpanded placeholder; signed transfer tokens are disabled")
+            return ""
+        return secret
+
     class Config:
         case_sensitive = True
         env_file = ".env"
@@ -0,0 +1,403 @@
+"""
+    Async storage backends so that handlers running on the event loop can read and write dataset files without
+    blocking it or tying up a threadpool slot per object.
+
+    Paths use the same `file://` and `s3://` URLs as `src.utils.get_rawfile`/`put_rawfile`. Parsers such as pyarrow
+    and pandas still run on worker threads: `open_file` gives them file objects that are served from the disk cache
+    or read with ranged GETs made by these backends on the event loop.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+from botocore.exceptions import ClientError
+
+from starlette.concurrency import run_in_threadpool
+
+from src.metrics import current_route, storage_timer
+from src.settings import settings
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+# Hostname suffix of the virtual-hosted style https URLs that processing jobs store in `data_paths`
+S3_HTTPS_SUFFIX = ".s3.amazonaws.com"
+
+
+def storage_url(path: str) -> str:
+    """Map an https S3 object URL (as stored in `data_paths`) onto its `s3://` equivalent."""
+    location_info = urlparse(path)
+    if location_info.scheme.lower() == "https" and location_info.netloc.endswith(S3_HTTPS_SUFFIX):
+        bucket = location_info.netloc[: -len(S3_HTTPS_SUFFIX)]
+        return f"s3://{bucket}{location_info.path}"
+    return path
+
+
+def _get_operation(start, end):
+    return "get" if not start and end is None else "get_range"
+
+
+class AsyncStorage:
+    """Interface shared by the async storage backends."""
+
+    async def head(self, path: str) -> Dict:
+        """Return the `size` and `etag` of the object at `path` (the ETag is None for local files)."""
+        raise NotImplementedError()
+
+    async def get(self, path: str, start: int = 0, end: Optional[int] = None, etag: Optional[str] = None) -> bytes:
+        """
+        Read the object at `path`, or the inclusive byte range `start`-`end` of it. When `etag` is given the read
+        fails if the object has been rewritten since.
+        """
+        raise NotImplementedError()
+
+    async def put(self, path: str, data: Union[bytes, object]) -> None:
+        """Write `data`, either bytes or a binary file object, to `path`."""
+        raise NotImplementedError()
+
+    async def list(self, path: str) -> List[Dict]:
+        """List the files below `path` as dicts with their `name`, `size` and `etag`."""
+        raise NotImplementedError()
+
+    def stream(
+        self, path: str, start: int = 0, end: Optional[int] = None, chunk_size: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        """Yield the object at `path` (or a byte range of it) in chunks of `chunk_size`."""
+        raise NotImplementedError()
+
+
+class LocalAsyncStorage(AsyncStorage):
+    """
+    Local filesystem backend. The OS has no usable async file API, so blocking calls run on a dedicated executor
+    rather than the shared Starlette threadpool.
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="local-storage"
+        )
+
+    async def run(self, func, *args):
+        """Run the blocking `func(*args)` on the backend's executor."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return os.stat(urlparse(path).path)
+        except FileNotFoundError:
+            raise FileNotFoundError(path)
+
+    @staticmethod
+    def _read(path, start, end):
+        with open(urlparse(path).path, "rb") as local_file:
+            local_file.seek(start)
+            if end is None:
+                return local_file.read()
+            return local_file.read(end - start + 1)
+
+    @staticmethod
+    def _write(path, data):
+        local_path = urlparse(path).path
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, "wb") as local_file:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                local_file.write(data)
+            else:
+                shutil.copyfileobj(data, local_file, settings.STORAGE_COPY_CHUNKSIZE)
+
+    async def open(self, path):
+        """Open the local file at `path` for reading."""
+        return await self.run(open, urlparse(path).path, "rb")
+
+    async def head(self, path):
+        with storage_timer("head", path):
+            stat = await self.run(self._stat, path)
+        return {"size": stat.st_size, "etag": None}
+
+    async def get(self, path, start=0, end=None, etag=None):
+        with storage_timer(_get_operation(start, end), path) as stats:
+            data = await self.run(self._read, path, start, end)
+            stats["bytes"] = len(data)
+        return data
+
+    async def put(self, path, data):
+        with storage_timer("put", path):
+            await self.run(self._write, path, data)
+
+    async def list(self, path):
+        from src.utils import iter_files
+
+        with storage_timer("list", path):
+            return await self.run(lambda: list(iter_files(path)))
+
+    async def stream(self, path, start=0, end=None, chunk_size=None):
+        chunk_size = chunk_size or settings.STORAGE_COPY_CHUNKSIZE
+        local_file = await self.open(path)
+        try:
+            await self.run(local_file.seek, start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                size = chunk_size if remaining is None else min(chunk_size, remaining)
+                chunk = await self.run(local_file.read, size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            await self.run(local_file.close)
+
+
+class S3AsyncStorage(AsyncStorage):
+    """
+    S3 backend built on aiobotocore. The client and its connection pool are created on first use, and again if
+    the backend is used from another event loop.
+    """
+
+    def __init__(self, max_pool_connections: int) -> None:
+        self._max_pool_connections = max_pool_connections
+        self._client = None
+        self._loop = None
+        self._exit_stack = None
+        self._lock = None
+
+    async def client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is not None and self._loop is loop:
+            return self._client
+
+        if self._loop is not loop:
+            # Clients and locks are bound to the loop they were created on
+            self._client, self._loop = None, loop
+            self._exit_stack, self._lock = AsyncExitStack(), asyncio.Lock()
+        async with self._lock:
+            if self._client is not None:
+                return self._client
+            logger.debug("Creating async S3 client")
+            session = get_session()
+            self._client = await self._exit_stack.enter_async_context(
+                session.create_client(
+                    "s3", config=AioConfig(max_pool_connections=self._max_pool_connections)
+                )
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
+        self._client = None
+        self._loop = None
+
+    @staticmethod
+    def _location(path):
+        location_info = urlparse(path)
+        return location_info.netloc, location_info.path.lstrip("/")
+
+    @staticmethod
+    def _not_found(e):
+        return e.response["Error"]["Code"] in ("NoSuchKey", "404")
+
+    async def head(self, path):
+        bucket, key = self._location(path)
+        client = await self.client()
+        with storage_timer("head", path):
+            try:
+                response = await client.head_object(Bucket=bucket, Key=key)
+            except ClientError as e:
+                if self._not_found(e):
+                    raise FileNotFoundError(path) from e
+                raise
+        return {"size": response["ContentLength"], "etag": response["ETag"]}
+
+    async def _get_object(self, path, start, end, etag=None):
+        bucket, key = self._location(path)
+        kwargs = {"Bucket": bucket, "Key": key}
+        if start or end is not None:
+            kwargs["Range"] = f"bytes={start}-{'' if end is None else end}"
+        if etag:
+            kwargs["IfMatch"] = etag
+        client = await self.client()
+        try:
+            return await client.get_object(**kwargs)
+        except ClientError as e:
+            if self._not_found(e):
+                raise FileNotFoundError(path) from e
+            raise
+
+    async def get(self, path, start=0, end=None, etag=None):
+        with storage_timer(_get_operation(start, end), path) as stats:
+            response = await self._get_object(path, start, end, etag)
+            async with response["Body"] as body:
+                data = await body.read()
+            stats["bytes"] = len(data)
+        return data
+
+    async def stream(self, path, start=0, end=None, chunk_size=None):
+        chunk_size = chunk_size or settings.STORAGE_COPY_CHUNKSIZE
+        response = await self._get_object(path, start, end)
+        async with response["Body"] as body:
+            async for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+
+    async def put(self, path, data):
+        with storage_timer("put", path):
+            await self._put(path, data)
+
+    async def _put(self, path, data):
+        bucket, key = self._location(path)
+        client = await self.client()
+        part_size = settings.S3_MULTIPART_CHUNKSIZE
+
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = io.BytesIO(data)
+        loop = asyncio.get_running_loop()
+
+        async def read_part():
+            return await loop.run_in_executor(None, data.read, part_size)
+
+        part = await read_part()
+        next_part = await read_part() if len(part) == part_size else b""
+        if not next_part:
+            await client.put_object(Bucket=bucket, Key=key, Body=part)
+            return
+
+        # Multipart upload with a bounded number of parts in flight, so memory stays at a few part sizes
+        upload = await client.create_multipart_upload(Bucket=bucket, Key=key)
+        upload_id = upload["UploadId"]
+        semaphore = asyncio.Semaphore(settings.S3_MULTIPART_CONCURRENCY)
+        pending = []
+
+        async def upload_part(part_number, body):
+            try:
+                response = await client.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=body
+                )
+                return {"PartNumber": part_number, "ETag": response["ETag"]}
+            finally:
+                semaphore.release()
+
+        try:
+            part_number = 0
+            while part:
+                part_number += 1
+                await semaphore.acquire()
+                pending.append(asyncio.ensure_future(upload_part(part_number, part)))
+                part, next_part = next_part, (await read_part() if next_part else b"")
+            parts = await asyncio.gather(*pending)
+            await client.complete_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            await client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    async def list(self, path):
+        bucket, prefix = self._location(path)
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        client = await self.client()
+        files = []
+        paginator = client.get_paginator("list_objects_v2")
+        with storage_timer("list", path):
+            async for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for s3_object in page.get("Contents", []):
+                    files.append(
+                        {
+                            "name": s3_object["Key"][len(prefix):],
+                            "size": s3_object["Size"],
+                            "etag": s3_object["ETag"],
+                        }
+                    )
+        return files
+
+
+local_storage = LocalAsyncStorage(max_workers=settings.ASYNC_STORAGE_CONCURRENCY)
+s3_storage = S3AsyncStorage(max_pool_connections=settings.ASYNC_STORAGE_CONCURRENCY)
+
+
+def get_storage(path: str) -> AsyncStorage:
+    scheme = urlparse(path).scheme.lower()
+    if scheme == "file":
+        return local_storage
+    elif scheme == "s3":
+        return s3_storage
+    else:
+        raise RuntimeError("File storage format is unknown")
+
+
+def run_from_thread(loop, coroutine_function, *args):
+    """
+    Run `coroutine_function(*args)` on the event loop `loop` from a worker thread and wait for its result. The
+    storage operations it records are labelled with the route of the request the thread works for.
+    """
+    route = current_route.get()
+
+    async def run():
+        current_route.set(route)
+        return await coroutine_function(*args)
+
+    return asyncio.run_coroutine_threadsafe(run(), loop).result()
+
+
+async def stat_file(path: str) -> Tuple[str, Dict]:
+    """
+    Return the URL holding the bytes of the file at `path`, with their `size` and `etag`. Deduplicated uploads are
+    stored once under a content-addressed key with a reference at `path`, which is followed.
+    """
+    from src.utils import REFERENCE_SUFFIX
+
+    try:
+        return path, await get_storage(path).head(path)
+    except FileNotFoundError:
+        try:
+            reference = json.loads(await get_storage(path).get(f"{path}{REFERENCE_SUFFIX}"))
+        except FileNotFoundError:
+            raise FileNotFoundError(path)
+        blob_path = reference["blob"]
+        return blob_path, await get_storage(blob_path).head(blob_path)
+
+
+async def open_file(path: str, read_ahead: Optional[int] = None):
+    """
+    Open a dataset or run file for parsing on a worker thread, making every storage round trip on the event loop.
+
+    Local files are opened on the local backend's executor. S3 objects are served from the disk cache when it holds
+    their current version, and otherwise read with ranged GETs of `read_ahead` bytes (S3_READ_AHEAD_BYTES by
+    default) through the S3 backend; the cache is not filled. https S3 URLs from `data_paths` are read as S3
+    objects, and any other URL falls back to the synchronous `get_rawfile` on the threadpool.
+
+    The file's reads block, so it must only be read off the event loop.
+    """
+    from src.utils import StorageRangeReader, get_rawfile, storage_cache
+
+    path = storage_url(path)
+    if urlparse(path).scheme.lower() not in ("file", "s3"):
+        return await run_in_threadpool(get_rawfile, path, False, read_ahead)
+
+    with storage_timer("open", path) as stats:
+        path, info = await stat_file(path)
+        if urlparse(path).scheme.lower() == "file":
+            local_file = await local_storage.open(path)
+            stats["bytes"] = info["size"]
+            return local_file
+
+        cached_file = await local_storage.run(storage_cache.lookup, path, info["etag"])
+        if cached_file is not None:
+            return cached_file
+        return io.BufferedReader(
+            StorageRangeReader(
+                get_storage(path), path, info["size"], info["etag"], asyncio.get_running_loop()
+            ),
+            buffer_size=read_ahead or settings.S3_READ_AHEAD_BYTES,
+        )
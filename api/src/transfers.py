@@ -0,0 +1,194 @@
+"""
+    Direct-to-storage transfers. Instead of streaming dataset bytes through the API workers, clients ask for a
+    short-lived URL and upload to or download from S3 themselves. Local `file://` storage has no presigned URLs, so
+    it is served by the signed-token routes at the bottom of this module, which answer 503 until
+    STORAGE_SIGNING_SECRET is set.
+"""
+import os
+from typing import Optional
+from urllib.parse import urlparse
+
+from elasticsearch.exceptions import NotFoundError
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.logger import logger
+from fastapi.responses import FileResponse, RedirectResponse
+from starlette.concurrency import run_in_threadpool
+
+from src.data import job
+from src.indicators import check_filename, raw_data_filename
+from src.previews import preview_cache
+from src.settings import settings
+from src.elastic import es
+from src.storage import storage_url
+from src.utils import (
+    REFERENCE_SUFFIX,
+    delete_rawfile,
+    get_rawfile_reference,
+    presign_rawfile,
+    rawfile_exists,
+    verify_storage_token,
+)
+
+router = APIRouter()
+
+
+def _require_signing_secret():
+    if not settings.STORAGE_SIGNING_SECRET:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Signed transfers of local files are disabled: STORAGE_SIGNING_SECRET is not set",
+        )
+
+
+def _presign(path: str, method: str, request: Request, route: str, filename: Optional[str] = None):
+    """Presign `path`, pointing local files at the signed-token `route`."""
+    if urlparse(path).scheme.lower() == "file":
+        _require_signing_secret()
+    return presign_rawfile(
+        path, method, lambda token: str(request.url_for(route, token=token)), filename=filename
+    )
+
+
+@router.post("/indicators/{indicator_id}/upload/presign")
+def presign_upload(
+    indicator_id: str,
+    original_filename: str,
+    request: Request,
+    filename: Optional[str] = None,
+    append: Optional[bool] = False,
+):
+    """
+    Issue a URL the client can PUT the file to directly. Call `/indicators/{indicator_id}/upload/confirm` with
+    the returned filename once the upload has finished.
+    """
+    filename = raw_data_filename(indicator_id, original_filename, filename, append)
+    dest_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, indicator_id, filename)
+    url = _presign(dest_path, "PUT", request, "put_signed_file")
+
+    return {
+        "id": indicator_id,
+        "filename": filename,
+        "method": "PUT",
+        "url": url,
+        "expires_in": settings.PRESIGNED_URL_EXPIRES,
+    }
+
+
+@router.post("/indicators/{indicator_id}/upload/confirm")
+async def confirm_upload(
+    indicator_id: str,
+    filename: str,
+    job_string: Optional[str] = "file_processors.file_conversion",
+):
+    """
+    Confirm that a presigned upload has finished and start processing it with `job_string`. Pass an empty
+    `job_string` to only confirm the upload.
+    """
+    check_filename(indicator_id)
+    check_filename(filename)
+    dest_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, indicator_id, filename)
+    if not await run_in_threadpool(rawfile_exists, dest_path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"{filename} has not been uploaded"
+        )
+    # A reference left by an earlier deduplicated upload of the same name would hide the new file from listings
+    await run_in_threadpool(delete_rawfile, f"{dest_path}{REFERENCE_SUFFIX}")
+    await preview_cache.invalidate(dest_path)
+
+    response = {"id": indicator_id, "filename": filename, "job": None}
+    if job_string:
+        response["job"] = await run_in_threadpool(
+            job, indicator_id, job_string, {"filename": filename, "force_restart": True}
+        )
+    return response
+
+
+@router.get("/indicators/{indicator_id}/download/presign")
+def presign_raw_download(
+    indicator_id: str, filename: str, request: Request, redirect: bool = False
+):
+    """Issue a URL to download an uploaded file directly, or redirect to it when `redirect` is set."""
+    check_filename(indicator_id)
+    check_filename(filename)
+    path = os.path.join(settings.DATASET_STORAGE_BASE_URL, indicator_id, filename)
+    if not rawfile_exists(path):
+        # Deduplicated uploads are stored once under a content-addressed key with a reference at `path`
+        reference = get_rawfile_reference(path)
+        if reference is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+        path = reference["blob"]
+
+    url = _presign(path, "GET", request, "get_signed_file", filename=filename)
+    if redirect:
+        return RedirectResponse(url)
+    return {"url": url, "expires_in": settings.PRESIGNED_URL_EXPIRES}
+
+
+@router.get("/dojo/download/presign/{index}/{obj_id}")
+def presign_processed_download(index: str, obj_id: str, request: Request):
+    """Issue download URLs for the processed parquet files (`data_paths`) of a dataset or run."""
+    try:
+        document = es.get(index=index, id=obj_id)["_source"]
+    except NotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    files = []
+    for data_path in document.get("data_paths", []):
+        path = storage_url(data_path)
+        if urlparse(path).scheme.lower() in ("file", "s3"):
+            url = _presign(
+                path, "GET", request, "get_signed_file", filename=os.path.basename(urlparse(path).path)
+            )
+        else:
+            # Anything else is already a plain URL the client can fetch
+            url = data_path
+        files.append({"path": data_path, "url": url})
+
+    return {"files": files, "expires_in": settings.PRESIGNED_URL_EXPIRES}
+
+
+# SIGNED TOKEN ROUTES FOR LOCAL STORAGE
+
+
+def _verified_path(token: str, method: str) -> str:
+    _require_signing_secret()
+    path = verify_storage_token(token, method)
+    if path is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid or expired token"
+        )
+    # Tokens only ever grant access to files under the storage base
+    storage_root = os.path.realpath(urlparse(settings.DATASET_STORAGE_BASE_URL).path)
+    local_path = os.path.realpath(urlparse(path).path)
+    if os.path.commonpath([storage_root, local_path]) != storage_root:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid or expired token")
+    return local_path
+
+
+@router.get("/storage/{token}")
+def get_signed_file(token: str):
+    local_path = _verified_path(token, "GET")
+    if not os.path.isfile(local_path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return FileResponse(local_path, filename=os.path.basename(local_path))
+
+
+@router.put("/storage/{token}", status_code=status.HTTP_201_CREATED)
+async def put_signed_file(token: str, request: Request):
+    local_path = _verified_path(token, "PUT")
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+    # Write to a temporary file and swap it in so readers never see a partial upload
+    temp_path = f"{local_path}.uploading"
+    local_file = await run_in_threadpool(open, temp_path, "wb")
+    try:
+        async for chunk in request.stream():
+            await run_in_threadpool(local_file.write, chunk)
+    except BaseException:
+        local_file.close()
+        os.remove(temp_path)
+        raise
+    await run_in_threadpool(local_file.close)
+    os.replace(temp_path, local_path)
+    logger.info(f"Stored signed upload at {local_path}")
+    return {"size": os.path.getsize(local_path)}
@@ -1,25 +1,77 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import io
+import json
 import os
+import pickle
+import queue
+import shutil
+import struct
+import tarfile
 import tempfile
+import threading
 import time
+import zipfile
 import csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from io import BytesIO, StringIO
-from zlib import compressobj
+import zlib
 
+import numpy as np
 import pandas as pd
-from elasticsearch import Elasticsearch
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import requests
+import zstandard
 import boto3
+import brotli
 import botocore
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 from src.settings import settings
+from src.elastic import es
+from src.metrics import propagate_route, register_cache, storage_timer
+from src.storage import get_storage, open_file, run_from_thread, stat_file, storage_url
 from validation import ModelSchema
 from fastapi.logger import logger
+from starlette.concurrency import run_in_threadpool
 
 
-es = Elasticsearch([settings.ELASTICSEARCH_URL], port=settings.ELASTICSEARCH_PORT)
-
 # S3 OBJECT
-s3 = boto3.client("s3")
+# One session and one pooled client are shared by every storage helper in the process; the pool has to be
+# at least as large as the transfer concurrency or parallel parts just queue for a connection.
+s3_session = boto3.session.Session()
+s3 = s3_session.client(
+    "s3",
+    config=Config(
+        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": settings.S3_MAX_ATTEMPTS, "mode": "standard"},
+    ),
+)
+
+# Large objects are uploaded in concurrent multipart chunks; only a handful of parts are ever held in memory
+upload_config = TransferConfig(
+    multipart_threshold=settings.S3_MULTIPART_CHUNKSIZE,
+    multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=settings.S3_MULTIPART_CONCURRENCY,
+)
+# Not exposed by boto3's constructor, but honoured by s3transfer when reading non-seekable streams
+upload_config.max_in_memory_upload_chunks = settings.S3_MULTIPART_CONCURRENCY
+
+# Objects above the threshold are downloaded as parallel ranged GETs
+download_config = TransferConfig(
+    multipart_threshold=settings.S3_DOWNLOAD_CHUNKSIZE,
+    multipart_chunksize=settings.S3_DOWNLOAD_CHUNKSIZE,
+    max_concurrency=settings.S3_DOWNLOAD_CONCURRENCY,
+)
 
 
 def try_parse_int(s: str, default: int = 0) -> int:
@@ -29,6 +81,13 @@ def try_parse_int(s: str, default: int = 0) -> int:
         return default
 
 
+def try_parse_float(s: str, default: float = 0.0) -> float:
+    try:
+        return float(s)
+    except ValueError:
+        return default
+
+
 def delete_matching_records_from_model(model_id, record_key, record_test):
     """
     This function provides an easy way to remove information from within a specific key of a model.
@@ -110,98 +169,1533 @@ def run_model_with_defaults(model_id):
     return run_id
 
 
-def get_rawfile(path):
+class RangeReader(io.RawIOBase):
+    """
+    Read-only, seekable file-like view of a remote object.
+
+    Bytes are fetched with ranged GETs as the caller reads them instead of downloading the whole object up
+    front. Wrap it in an `io.BufferedReader` (as `get_rawfile` does) to get a read-ahead buffer, so that
+    parsers issuing many small reads only cost one request per buffer fill. Every range request is pinned to
+    the ETag seen when the reader was opened so a concurrent overwrite can't produce a mixed read.
+
+    Subclasses set `size` and `etag` and implement `_fetch_range`.
+    """
+
+    size = 0
+    etag = None
+    _position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return self._position
+
+    def _fetch_range(self, byte_range):
+        raise NotImplementedError()
+
+    def _get_range(self, start, end=None):
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+        with storage_timer("get_range", self.name) as stats:
+            data = self._fetch_range(byte_range)
+            stats["bytes"] = len(data)
+        return data
+
+    def readinto(self, buffer):
+        if self._position >= self.size or len(buffer) == 0:
+            return 0
+        end = min(self._position + len(buffer), self.size) - 1
+        data = self._get_range(self._position, end)
+        size = len(data)
+        buffer[:size] = data
+        self._position += size
+        return size
+
+    def readall(self):
+        # The default implementation loops over small reads, which would turn into one request per 8KiB
+        if self._position >= self.size:
+            return b""
+        data = self._get_range(self._position)
+        self._position += len(data)
+        return data
+
+
+class S3RangeReader(RangeReader):
+    """`RangeReader` over an S3 object."""
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        head = s3.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+
+    @property
+    def name(self):
+        return f"s3://{self.bucket}/{self.key}"
+
+    def _fetch_range(self, byte_range):
+        response = s3.get_object(Bucket=self.bucket, Key=self.key, Range=byte_range, IfMatch=self.etag)
+        return response["Body"].read()
+
+
+class HTTPRangeReader(RangeReader):
+    """`RangeReader` over an http(s) URL. Use `open` to fall back when the server doesn't serve byte ranges."""
+
+    def __init__(self, url, size, etag):
+        self.url = url
+        self.size = size
+        self.etag = etag
+
+    @classmethod
+    def open(cls, url):
+        """A reader for `url`, or None if the server doesn't announce byte range support and a length."""
+        response = requests.head(url, allow_redirects=True)
+        if response.status_code == 404:
+            raise FileNotFoundError(url)
+        response.raise_for_status()
+        size = response.headers.get("Content-Length")
+        if response.headers.get("Accept-Ranges", "").lower() != "bytes" or size is None:
+            return None
+        return cls(response.url, int(size), response.headers.get("ETag"))
+
+    @property
+    def name(self):
+        return self.url
+
+    def _fetch_range(self, byte_range):
+        headers = {"Range": byte_range}
+        if self.etag:
+            headers["If-Match"] = self.etag
+        response = requests.get(self.url, headers=headers)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"{self.url} ignored the byte range {byte_range}")
+        return response.content
+
+
+class StorageRangeReader(RangeReader):
+    """
+    `RangeReader` whose ranged GETs are made by an async storage backend (see `src.storage`) on the event loop
+    `loop`, so that parsers on worker threads share the backend's connections. It must not be read on `loop` itself.
+    The backend records every request, so it replaces `_get_range` rather than `_fetch_range`.
+    """
+
+    def __init__(self, storage, path, size, etag, loop):
+        self.storage = storage
+        self.path = path
+        self.size = size
+        self.etag = etag
+        self.loop = loop
+
+    @property
+    def name(self):
+        return self.path
+
+    def _get_range(self, start, end=None):
+        return run_from_thread(self.loop, self.storage.get, self.path, start, end, self.etag)
+
+
+class StorageCache:
+    """
+    Size-capped, least-recently-used disk cache for remote storage objects.
+
+    Entries are keyed by URL and remember the ETag they were fetched with. Every open revalidates the entry
+    with a conditional GET, so an unchanged object is served from local disk and a rewritten one is fetched
+    again. Recency is tracked through the mtime of the cached files so that it is shared by every process
+    using the same cache directory.
+    """
+
+    def __init__(self, directory, max_bytes, max_object_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _entry_paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return (
+            os.path.join(self.directory, f"{key}.data"),
+            os.path.join(self.directory, f"{key}.etag"),
+        )
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def open(self, url, fetch):
+        """
+        Open `url` from the cache, calling `fetch(etag)` to revalidate or fill the entry.
+
+        `fetch` returns None when the cached ETag is still current, otherwise a tuple of the new ETag, the
+        object size, a function writing the object into a file and a function releasing the request. Returns
+        None if the object can't be cached, in which case the caller should read it from storage directly.
+        """
+        data_path, etag_path = self._entry_paths(url)
+        try:
+            with open(etag_path) as etag_file:
+                cached_etag = etag_file.read()
+        except FileNotFoundError:
+            cached_etag = None
+
+        fetched = fetch(cached_etag)
+        if fetched is None:
+            try:
+                cached_file = open(data_path, "rb")
+                os.utime(data_path)
+                self._count(hit=True)
+                return cached_file
+            except FileNotFoundError:
+                # Evicted between revalidation and open, fetch it again unconditionally
+                fetched = fetch(None)
+
+        self._count(hit=False)
+        etag, size, write, close = fetched
+        if not etag or size is None or size > self.max_object_bytes:
+            close()
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as temp_file:
+                with storage_timer("cache_fill", url) as stats:
+                    write(temp_file)
+                    stats["bytes"] = temp_file.tell()
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+        finally:
+            close()
+        # Drop the old ETag before swapping the data so a reader can never pair stale data with a new ETag
+        try:
+            os.remove(etag_path)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_file.name, data_path)
+        with open(etag_path, "w") as etag_file:
+            etag_file.write(etag)
+
+        cached_file = open(data_path, "rb")
+        self._evict(keep=data_path)
+        return cached_file
+
+    def lookup(self, url, etag):
+        """
+        Open the cached copy of `url` if it holds the version with `etag`, without revalidating or filling the
+        entry. Returns None otherwise.
+        """
+        if not self.enabled or not etag:
+            return None
+        data_path, etag_path = self._entry_paths(url)
+        try:
+            with open(etag_path) as etag_file:
+                if etag_file.read() != etag:
+                    return None
+            cached_file = open(data_path, "rb")
+        except FileNotFoundError:
+            return None
+        # An entry refilled in the meantime has had its ETag file replaced as well
+        try:
+            with open(etag_path) as etag_file:
+                current = etag_file.read() == etag
+        except FileNotFoundError:
+            current = False
+        if not current:
+            cached_file.close()
+            return None
+        os.utime(data_path)
+        self._count(hit=True)
+        return cached_file
+
+    def _evict(self, keep):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".data"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            for stale_path in (path[: -len(".data")] + ".etag", path):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+
+
+storage_cache = StorageCache(
+    directory=settings.STORAGE_CACHE_DIR,
+    max_bytes=settings.STORAGE_CACHE_MAX_BYTES,
+    max_object_bytes=settings.STORAGE_CACHE_MAX_OBJECT_BYTES,
+)
+register_cache("storage_cache", storage_cache)
+
+
+def _fetch_s3(bucket, key, etag):
+    kwargs = {"Bucket": bucket, "Key": key}
+    if etag:
+        kwargs["IfNoneMatch"] = etag
+    try:
+        head = s3.head_object(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        if e.response["ResponseMetadata"]["HTTPStatusCode"] == 304:
+            return None
+        raise
+
+    def write(fileobj):
+        # Large objects are fetched as parallel ranged GETs
+        s3.download_fileobj(Bucket=bucket, Key=key, Fileobj=fileobj, Config=download_config)
+
+    return head["ETag"], head["ContentLength"], write, lambda: None
+
+
+def _fetch_http(url, etag):
+    headers = {"If-None-Match": etag} if etag else {}
+    response = requests.get(url, headers=headers, stream=True)
+    if response.status_code == 304:
+        response.close()
+        return None
+    if response.status_code == 404:
+        response.close()
+        raise FileNotFoundError(url)
+    response.raise_for_status()
+    size = response.headers.get("Content-Length")
+    # Let the raw stream undo any transfer encoding so the cached bytes are the object's bytes
+    response.raw.decode_content = True
+    return (
+        response.headers.get("ETag"),
+        int(size) if size is not None else None,
+        lambda fileobj: shutil.copyfileobj(response.raw, fileobj, settings.STORAGE_COPY_CHUNKSIZE),
+        response.close,
+    )
+
+
+def _open_rawfile(path, cache, read_ahead=None):
     location_info = urlparse(path)
+    scheme = location_info.scheme.lower()
+    use_cache = cache and storage_cache.enabled
 
-    if location_info.scheme.lower() == "file":
+    if scheme == "file":
         raw_file = open(location_info.path, "rb")
-    elif location_info.scheme.lower() == "s3":
+    elif scheme == "s3":
         try:
             file_path = location_info.path.lstrip("/")
-            raw_file = tempfile.TemporaryFile()
-            s3.download_fileobj(
-                Bucket=location_info.netloc, Key=file_path, Fileobj=raw_file
-            )
-            raw_file.seek(0)
+            raw_file = None
+            if use_cache:
+                raw_file = storage_cache.open(
+                    path, functools.partial(_fetch_s3, location_info.netloc, file_path)
+                )
+            if raw_file is None:
+                raw_file = io.BufferedReader(
+                    S3RangeReader(bucket=location_info.netloc, key=file_path),
+                    buffer_size=read_ahead or settings.S3_READ_AHEAD_BYTES,
+                )
         except botocore.exceptions.ClientError as e:
             raise FileNotFoundError()
+    elif scheme in ("http", "https"):
+        raw_file = None
+        if use_cache:
+            raw_file = storage_cache.open(path, functools.partial(_fetch_http, path))
+        if raw_file is None:
+            range_reader = HTTPRangeReader.open(path)
+            if range_reader is not None:
+                raw_file = io.BufferedReader(range_reader, buffer_size=read_ahead or settings.S3_READ_AHEAD_BYTES)
+        if raw_file is None:
+            # Parquet readers need to seek, so uncached downloads from servers without range support are spooled
+            etag, size, write, close = _fetch_http(path, etag=None)
+            raw_file = tempfile.TemporaryFile()
+            try:
+                with storage_timer("download", path) as stats:
+                    write(raw_file)
+                    stats["bytes"] = raw_file.tell()
+            finally:
+                close()
+            raw_file.seek(0)
     else:
         raise RuntimeError("File storage format is unknown")
 
     return raw_file
 
 
+# Suffix of the lightweight reference objects that point a dataset file at its content-addressed blob
+REFERENCE_SUFFIX = ".ref"
+
+
+def get_rawfile_reference(path):
+    """
+    Return the reference stored for `path` (a dict with the `blob` URL, its `sha256` and `size`) or None if the
+    file at `path` is stored directly.
+    """
+    try:
+        reference_file = _open_rawfile(f"{path}{REFERENCE_SUFFIX}", cache=False)
+    except FileNotFoundError:
+        return None
+    with reference_file:
+        return json.load(reference_file)
+
+
+def get_rawfile(path, cache=True, read_ahead=None):
+    """
+    Open the file at `path` for reading. Uncached S3 objects are read with ranged GETs of `read_ahead` bytes
+    (S3_READ_AHEAD_BYTES by default).
+
+    Opening a local file records its size as the bytes of the operation. Remote reads record the bytes they
+    transfer themselves, as `get_range`, `cache_fill` or `download` operations.
+    """
+    with storage_timer("open", path) as stats:
+        opened_path = path
+        try:
+            raw_file = _open_rawfile(path, cache, read_ahead)
+        except FileNotFoundError:
+            # Deduplicated uploads are stored once under a content-addressed key with a reference at `path`
+            reference = get_rawfile_reference(path)
+            if reference is None:
+                raise
+            opened_path = reference["blob"]
+            raw_file = _open_rawfile(opened_path, cache, read_ahead)
+        if urlparse(opened_path).scheme.lower() == "file":
+            stats["bytes"] = os.fstat(raw_file.fileno()).st_size
+        return raw_file
+
+
+def read_parquet_head(source, nrows):
+    """
+    Read the first `nrows` rows of the parquet file open as `source` into a DataFrame. Only the footer and the
+    leading pages of each column are read, even when the file is a single large row group.
+    """
+    parquet_file = pq.ParquetFile(source, buffer_size=settings.PREVIEW_READ_AHEAD_BYTES, pre_buffer=False)
+    batches = []
+    rows = 0
+    for batch in parquet_file.iter_batches(batch_size=nrows):
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= nrows:
+            break
+    table = pa.Table.from_batches(batches, schema=parquet_file.schema_arrow).slice(0, nrows)
+    df = table.to_pandas()
+
+    # Arrow only restores a RangeIndex kept in the pandas metadata when every row is read, so rebuild it for the head
+    index_columns = (table.schema.pandas_metadata or {}).get("index_columns", [])
+    if len(index_columns) == 1 and isinstance(index_columns[0], dict) and index_columns[0].get("kind") == "range":
+        range_index = index_columns[0]
+        start, step = range_index["start"], range_index["step"]
+        df.index = pd.RangeIndex(start, start + step * len(df), step, name=range_index.get("name"))
+    return df
+
+
+def read_csv_head(source, nrows, **kwargs):
+    """Read the first `nrows` rows of the CSV file open as `source` into a DataFrame, reading only the bytes needed."""
+    return pd.read_csv(source, nrows=nrows, **kwargs)
+
+
+def sample_parquet(sources, nrows, seed=None):
+    """
+    Sample `nrows` rows uniformly across the parquet files open as `sources`, skipping the ones that are None. Row
+    positions are drawn from the row counts in the footers, so only the row groups holding a sampled row are
+    read. Those are decoded in batches of PREVIEW_SAMPLE_CHUNK_ROWS, keeping just the sampled rows of each, up to
+    the last sampled row, so memory is bounded by the sample and one batch. Returns a DataFrame per file (or None),
+    indexed by the position of each row in its file.
+    """
+    rng = np.random.default_rng(seed)
+    parquet_files = [
+        None if source is None
+        else pq.ParquetFile(source, buffer_size=settings.PREVIEW_READ_AHEAD_BYTES, pre_buffer=False)
+        for source in sources
+    ]
+
+    file_rows = [0 if parquet_file is None else parquet_file.metadata.num_rows for parquet_file in parquet_files]
+    file_starts = np.cumsum([0] + file_rows)
+    positions = np.sort(rng.choice(file_starts[-1], size=min(nrows, file_starts[-1]), replace=False))
+
+    samples = []
+    for index, parquet_file in enumerate(parquet_files):
+        if parquet_file is None:
+            samples.append(None)
+            continue
+        file_positions = positions[(positions >= file_starts[index]) & (positions < file_starts[index + 1])]
+        file_positions = file_positions - file_starts[index]
+        group_starts = np.cumsum(
+            [0] + [parquet_file.metadata.row_group(group).num_rows for group in range(parquet_file.num_row_groups)]
+        )
+        groups = np.searchsorted(group_starts, file_positions, side="right") - 1
+        columns = _parquet_columns(parquet_file.schema_arrow)
+        tables = []
+        for group in np.unique(groups):
+            offsets = file_positions[groups == group] - group_starts[group]
+            batch_start = 0
+            for batch in parquet_file.iter_batches(
+                batch_size=settings.PREVIEW_SAMPLE_CHUNK_ROWS, row_groups=[int(group)], columns=columns
+            ):
+                batch_offsets = offsets[(offsets >= batch_start) & (offsets < batch_start + batch.num_rows)]
+                if len(batch_offsets):
+                    tables.append(pa.Table.from_batches([batch.take(pa.array(batch_offsets - batch_start))]))
+                batch_start += batch.num_rows
+                if batch_start > offsets[-1]:
+                    break
+        table = pa.concat_tables(tables) if tables else parquet_file.schema_arrow.empty_table()
+        sample = table.to_pandas()
+        sample.index = file_positions
+        samples.append(sample)
+    return samples
+
+
+def sample_csv(source, nrows, seed=None, **kwargs):
+    """
+    Sample `nrows` rows uniformly from the CSV file open as `source`, indexed by their position in the file. It is
+    read once in chunks of PREVIEW_SAMPLE_CHUNK_ROWS, keeping the rows with the lowest of a random priority given to
+    every row, so memory is bounded by the sample and one chunk.
+    """
+    rng = np.random.default_rng(seed)
+    sample, priorities = None, None
+    for chunk in pd.read_csv(source, chunksize=settings.PREVIEW_SAMPLE_CHUNK_ROWS, **kwargs):
+        chunk_priorities = rng.random(len(chunk))
+        if sample is None:
+            sample, priorities = chunk, chunk_priorities
+        else:
+            sample = pd.concat([sample, chunk])
+            priorities = np.concatenate([priorities, chunk_priorities])
+        if len(sample) > nrows:
+            keep = np.argpartition(priorities, nrows)[:nrows]
+            sample, priorities = sample.iloc[keep], priorities[keep]
+    if sample is None:
+        return pd.DataFrame()
+    return sample.sort_index()
+
+
 def put_rawfile(path, fileobj):
     location_info = urlparse(path)
 
+    with storage_timer("put", path) as stats:
+        if location_info.scheme.lower() == "file":
+            if not os.path.isdir(os.path.dirname(location_info.path)):
+                os.makedirs(os.path.dirname(location_info.path), exist_ok=True)
+            with open(location_info.path, "wb") as output_file:
+                shutil.copyfileobj(fileobj, output_file, settings.STORAGE_COPY_CHUNKSIZE)
+                stats["bytes"] = output_file.tell()
+        elif location_info.scheme.lower() == "s3":
+            output_path = location_info.path.lstrip("/")
+            uploaded = [0]
+            s3.upload_fileobj(
+                fileobj,
+                Bucket=location_info.netloc,
+                Key=output_path,
+                Config=upload_config,
+                Callback=lambda size: uploaded.__setitem__(0, uploaded[0] + size),
+            )
+            stats["bytes"] = uploaded[0]
+        else:
+            raise RuntimeError("File storage format is unknown")
+
+
+def rawfile_exists(path):
+    location_info = urlparse(path)
+
     if location_info.scheme.lower() == "file":
-        if not os.path.isdir(os.path.dirname(location_info.path)):
-            os.makedirs(os.path.dirname(location_info.path), exist_ok=True)
-        with open(location_info.path, "wb") as output_file:
-            output_file.write(fileobj.read())
+        return os.path.isfile(location_info.path)
     elif location_info.scheme.lower() == "s3":
-        output_path = location_info.path.lstrip("/")
-        s3.put_object(Bucket=location_info.netloc, Key=output_path, Body=fileobj)
+        try:
+            with storage_timer("exists", path):
+                s3.head_object(Bucket=location_info.netloc, Key=location_info.path.lstrip("/"))
+        except botocore.exceptions.ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                return False
+            raise
+        return True
     else:
         raise RuntimeError("File storage format is unknown")
 
 
-def list_files(path):
+def rawfile_info(path):
+    """
+    Size and ETag of the file at `path`, without reading it. Local files get an ETag from their modification
+    time and size, like `iter_files`. Raises FileNotFoundError if there is no such file.
+    """
+    location_info = urlparse(path)
+    scheme = location_info.scheme.lower()
+
+    if scheme == "file":
+        stat = os.stat(location_info.path)
+        return {"size": stat.st_size, "etag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'}
+    elif scheme == "s3":
+        try:
+            with storage_timer("head", path):
+                response = s3.head_object(Bucket=location_info.netloc, Key=location_info.path.lstrip("/"))
+        except botocore.exceptions.ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                raise FileNotFoundError(path) from e
+            raise
+        return {"size": response["ContentLength"], "etag": response["ETag"]}
+    elif scheme in ("http", "https"):
+        response = requests.head(path, allow_redirects=True)
+        if response.status_code == 404:
+            raise FileNotFoundError(path)
+        response.raise_for_status()
+        return {
+            "size": try_parse_int(response.headers.get("Content-Length", "")),
+            "etag": response.headers.get("ETag"),
+        }
+    else:
+        raise RuntimeError("File storage format is unknown")
+
+
+def rawfile_identity(path):
+    """
+    A string that changes whenever the file at `path` is rewritten: its ETag, or the content hash of a
+    deduplicated upload. None if there is no such file.
+    """
+    try:
+        return rawfile_info(path)["etag"]
+    except FileNotFoundError:
+        reference = get_rawfile_reference(path)
+        return None if reference is None else f"sha256:{reference['sha256']}"
+
+
+def delete_rawfile(path):
+    location_info = urlparse(path)
+
+    if location_info.scheme.lower() == "file":
+        try:
+            os.remove(location_info.path)
+        except FileNotFoundError:
+            pass
+    elif location_info.scheme.lower() == "s3":
+        with storage_timer("delete", path):
+            s3.delete_object(Bucket=location_info.netloc, Key=location_info.path.lstrip("/"))
+    else:
+        raise RuntimeError("File storage format is unknown")
+
+
+def put_rawfile_deduplicated(path, fileobj):
+    """
+    Store the contents of `fileobj` once under a content-addressed key and write a reference to it at `path`.
+
+    The file is hashed in a single pass; if a blob with the same SHA-256 already exists nothing else is
+    uploaded. `fileobj` must be seekable, which is the case for FastAPI's spooled `UploadFile.file`.
+
+    Returns the reference, with `duplicate` set when the contents were already stored.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: fileobj.read(settings.STORAGE_COPY_CHUNKSIZE), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    sha256 = digest.hexdigest()
+
+    _, ext = os.path.splitext(path)
+    blob_path = os.path.join(
+        settings.DATASET_STORAGE_BASE_URL, "_blobs", "sha256", sha256[:2], f"{sha256}{ext}"
+    )
+    duplicate = rawfile_exists(blob_path)
+    if not duplicate:
+        fileobj.seek(0)
+        put_rawfile(blob_path, fileobj)
+
+    reference = {"blob": blob_path, "sha256": sha256, "size": size}
+    put_rawfile(f"{path}{REFERENCE_SUFFIX}", BytesIO(json.dumps(reference).encode()))
+    # A file stored directly at `path` by an earlier upload would otherwise shadow the new reference
+    delete_rawfile(path)
+
+    return {**reference, "duplicate": duplicate}
+
+
+def sign_storage_token(path, method, expires_in):
+    """
+    Sign a token granting `method` ("GET" or "PUT") access to the local storage `path` for `expires_in` seconds.
+    This is the `file://` counterpart of an S3 presigned URL.
+    """
+    if not settings.STORAGE_SIGNING_SECRET:
+        raise RuntimeError("STORAGE_SIGNING_SECRET is not set")
+    payload = {"path": path, "method": method, "expires": int(time.time()) + expires_in}
+    encoded = base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+    signature = hmac.new(
+        settings.STORAGE_SIGNING_SECRET.encode(), encoded.encode(), hashlib.sha256
+    ).hexdigest()
+    return f"{encoded}.{signature}"
+
+
+def verify_storage_token(token, method):
+    """Return the path a `sign_storage_token` token grants `method` access to, or None if it is invalid or expired."""
+    if not settings.STORAGE_SIGNING_SECRET:
+        return None
+    encoded, _, signature = token.partition(".")
+    expected = hmac.new(
+        settings.STORAGE_SIGNING_SECRET.encode(), encoded.encode(), hashlib.sha256
+    ).hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        return None
+    payload = json.loads(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)))
+    if payload["method"] != method or payload["expires"] < time.time():
+        return None
+    return payload["path"]
+
+
+def presign_rawfile(path, method, token_url, expires_in=None, filename=None):
+    """
+    Return a short-lived URL that lets a client GET or PUT the file at `path` without going through the API.
+
+    S3 objects get a presigned URL. Local files get a signed token, which `token_url` turns into the URL of the
+    route that serves it. When `filename` is given downloads are sent as an attachment with that name.
+    """
+    expires_in = expires_in or settings.PRESIGNED_URL_EXPIRES
     location_info = urlparse(path)
+
     if location_info.scheme.lower() == "file":
-        return os.listdir(location_info.path)
+        return token_url(sign_storage_token(path, method, expires_in))
     elif location_info.scheme.lower() == "s3":
-        s3_list = s3.list_objects(
-            Bucket=location_info.netloc, Marker=location_info.path
+        params = {"Bucket": location_info.netloc, "Key": location_info.path.lstrip("/")}
+        if method == "GET" and filename:
+            params["ResponseContentDisposition"] = f'attachment; filename="{filename}"'
+        return s3.generate_presigned_url(
+            "get_object" if method == "GET" else "put_object",
+            Params=params,
+            ExpiresIn=expires_in,
+            HttpMethod=method,
         )
-        s3_contents = s3_list["Contents"]
-        final_file_list = []
-        for x in s3_contents:
-            filename = x["Key"]
-            final_file_list.append(f"{location_info.path}/{filename}")
+    else:
+        raise RuntimeError("File storage format is unknown")
+
+
+def _iter_s3_listing(bucket, prefix, delimiter=None):
+    """Page through `list_objects_v2`, yielding each page as it arrives."""
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    while True:
+        with storage_timer("list", f"s3://{bucket}/{prefix}"):
+            page = s3.list_objects_v2(**kwargs)
+        yield page
+        if not page.get("IsTruncated"):
+            break
+        kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+def _list_s3_prefix(bucket, prefix):
+    return [
+        s3_object
+        for page in _iter_s3_listing(bucket, prefix)
+        for s3_object in page.get("Contents", [])
+    ]
+
+
+def iter_files(path, concurrency=None):
+    """
+    Lazily yield every file below `path` as a dict with its `name` (relative to `path`), `size` and `etag`.
 
-        return final_file_list
+    S3 listings are paginated with continuation tokens, so there is no cap on the number of keys. When
+    `concurrency` is greater than one, the sub-prefixes directly below `path` are listed in parallel and their
+    results are yielded in prefix order.
+    """
+    location_info = urlparse(path)
+    if concurrency is None:
+        concurrency = settings.STORAGE_LIST_CONCURRENCY
+
+    if location_info.scheme.lower() == "file":
+        root = location_info.path
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                yield {
+                    "name": os.path.relpath(file_path, root),
+                    "size": stat.st_size,
+                    "etag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                }
+    elif location_info.scheme.lower() == "s3":
+        bucket = location_info.netloc
+        prefix = location_info.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+
+        def to_entry(s3_object):
+            return {
+                "name": s3_object["Key"][len(prefix):],
+                "size": s3_object["Size"],
+                "etag": s3_object["ETag"],
+            }
+
+        if concurrency <= 1:
+            for page in _iter_s3_listing(bucket, prefix):
+                for s3_object in page.get("Contents", []):
+                    yield to_entry(s3_object)
+            return
+
+        sub_prefixes = []
+        for page in _iter_s3_listing(bucket, prefix, delimiter="/"):
+            for s3_object in page.get("Contents", []):
+                yield to_entry(s3_object)
+            sub_prefixes.extend(common["Prefix"] for common in page.get("CommonPrefixes", []))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for s3_objects in executor.map(
+                propagate_route(functools.partial(_list_s3_prefix, bucket)), sub_prefixes
+            ):
+                for s3_object in s3_objects:
+                    yield to_entry(s3_object)
     else:
         raise RuntimeError("File storage format is unknown")
 
 
-async def stream_csv_from_data_paths(data_paths, wide_format='false'):
-    # Build single dataframe
-    df = pd.concat(pd.read_parquet(file) for file in data_paths)
+def list_files(path):
+    return [entry["name"] for entry in iter_files(path)]
+
+
+def _parquet_columns(schema):
+    """Data columns of a parquet file's Arrow `schema`, leaving out any pandas index stored alongside them."""
+    index_columns = {
+        column
+        for column in (schema.pandas_metadata or {}).get("index_columns", [])
+        if isinstance(column, str)
+    }
+    return [name for name in schema.names if name not in index_columns]
+
+
+def _export_schema(footers):
+    """
+    Combined schema of the exported files, given their parquet `footers`, columns in order of first appearance. A
+    column that is typed differently across files (such as `value` in the numeric and `_str` outputs) is widened
+    to float or string.
+    """
+    fields = {}
+    for footer in footers:
+        schema = footer.schema.to_arrow_schema()
+        for name in _parquet_columns(schema):
+            field = schema.field(name)
+            current = fields.get(name)
+            if current is None or pa.types.is_null(current.type):
+                fields[name] = field
+            elif not pa.types.is_null(field.type) and field.type != current.type:
+                numeric = all(
+                    pa.types.is_integer(t) or pa.types.is_floating(t) for t in (field.type, current.type)
+                )
+                fields[name] = pa.field(name, pa.float64() if numeric else pa.string())
+    return pa.schema([field.remove_metadata() for field in fields.values()])
+
+
+def _align_table(table, schema):
+    """Lay `table` out with the export `schema`: missing columns become nulls and the rest are cast to its types."""
+    arrays = []
+    for field in schema:
+        if field.name not in table.column_names:
+            arrays.append(pa.nulls(table.num_rows, field.type))
+            continue
+        array = table.column(field.name)
+        if array.type != field.type:
+            if pa.types.is_floating(array.type):
+                array = pc.if_else(pc.is_nan(array), pa.scalar(None, array.type), array)
+            array = array.cast(field.type)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _csv_table(table):
+    """Match the previous pandas-based CSV export: NaN is written as an empty field and booleans as True/False."""
+    arrays = []
+    for array in table.columns:
+        if pa.types.is_floating(array.type):
+            array = pc.if_else(pc.is_nan(array), pa.scalar(None, array.type), array)
+        elif pa.types.is_boolean(array.type):
+            array = pc.if_else(array, "True", "False")
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=table.column_names)
+
+
+def _decode_dictionary(array):
+    """`array` with dictionary encoding undone, so it can be compared with plain values."""
+    if pa.types.is_dictionary(array.type):
+        return array.cast(array.type.value_type)
+    return array
+
+
+def _filter_bound(value, value_type):
+    """
+    A one-element array holding `value` cast to a column's `value_type` (an integer timestamp bound becomes a
+    timestamp in the column's unit), or None if the column can't represent it, in which case it matches no row.
+    Numbers aren't compared with text columns, where they would be ordered as strings.
+    """
+    if not isinstance(value, str) and (pa.types.is_string(value_type) or pa.types.is_large_string(value_type)):
+        return None
+    try:
+        return pa.array([value]).cast(value_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return None
+
+
+class ExportFilter:
+    """
+    Rows and columns selected for an export. The predicates are pushed down into the parquet reads: files and row
+    groups whose statistics rule out a match are skipped, only the needed columns are read, and the remaining rows
+    are filtered in Arrow.
+
+    `features`, `country` and `admin1`-`admin3` match any of the given values, the timestamp bounds are
+    inclusive, and `bbox` is `(min_lng, min_lat, max_lng, max_lat)`. `columns` limits the exported columns;
+    names that aren't in the data are ignored.
+    """
+
+    def __init__(
+        self,
+        features=None,
+        timestamp_gte=None,
+        timestamp_lte=None,
+        country=None,
+        admin1=None,
+        admin2=None,
+        admin3=None,
+        bbox=None,
+        columns=None,
+    ):
+        self.value_sets = {
+            column: list(values)
+            for column, values in (
+                ("feature", features),
+                ("country", country),
+                ("admin1", admin1),
+                ("admin2", admin2),
+                ("admin3", admin3),
+            )
+            if values
+        }
+        self.ranges = {}
+        if timestamp_gte is not None or timestamp_lte is not None:
+            self.ranges["timestamp"] = (timestamp_gte, timestamp_lte)
+        if bbox is not None:
+            min_lng, min_lat, max_lng, max_lat = bbox
+            self.ranges["lng"] = (min_lng, max_lng)
+            self.ranges["lat"] = (min_lat, max_lat)
+        self.columns = list(columns) if columns else None
+
+    @property
+    def selects_all(self):
+        return not self.predicate_columns and self.columns is None
+
+    @property
+    def predicate_columns(self):
+        return list(self.value_sets) + list(self.ranges)
+
+    def file_may_match(self, column_names):
+        # A column missing from a file is null for all of its rows, which never matches
+        return all(column in column_names for column in self.predicate_columns)
+
+    def row_group_may_match(self, row_group):
+        statistics = {}
+        for index in range(row_group.num_columns):
+            column = row_group.column(index)
+            if column.statistics is not None and column.statistics.has_min_max:
+                statistics[column.path_in_schema] = (column.statistics.min, column.statistics.max)
+
+        try:
+            for column, values in self.value_sets.items():
+                if column in statistics:
+                    low, high = statistics[column]
+                    if not any(low <= value <= high for value in values):
+                        return False
+            for column, (gte, lte) in self.ranges.items():
+                if column in statistics:
+                    low, high = statistics[column]
+                    if (gte is not None and high < gte) or (lte is not None and low > lte):
+                        return False
+        except TypeError:
+            # Statistics of an unexpected type can't rule anything out
+            return True
+        return True
 
-    # Ensure pandas floats are used because vanilla python ones are problematic
-    df = df.fillna('').astype(
-        {col: 'str' for col in df.select_dtypes(include=['float32', 'float64']).columns},
-        # Note: This links it to the previous `df` so not a full copy
-        copy=False
+    def filter_table(self, table):
+        mask = None
+        for column, values in self.value_sets.items():
+            array = _decode_dictionary(table.column(column))
+            if pa.types.is_null(array.type):
+                return table.slice(0, 0)
+            value_set = [_filter_bound(value, array.type) for value in values]
+            value_set = [bound for bound in value_set if bound is not None]
+            if not value_set:
+                return table.slice(0, 0)
+            condition = pc.is_in(array, value_set=pa.concat_arrays(value_set))
+            mask = condition if mask is None else pc.and_kleene(mask, condition)
+        for column, (gte, lte) in self.ranges.items():
+            array = _decode_dictionary(table.column(column))
+            if pa.types.is_null(array.type):
+                return table.slice(0, 0)
+            for bound, compare in ((gte, pc.greater_equal), (lte, pc.less_equal)):
+                if bound is not None:
+                    bound = _filter_bound(bound, array.type)
+                    if bound is None:
+                        return table.slice(0, 0)
+                    condition = compare(array, bound[0])
+                    mask = condition if mask is None else pc.and_kleene(mask, condition)
+        return table if mask is None else table.filter(mask)
+
+    def select(self, schema):
+        """The exported part of `schema`."""
+        if self.columns is None:
+            return schema
+        return pa.schema([schema.field(column) for column in self.columns if column in schema.names])
+
+    def read_schema(self, schema):
+        """The part of `schema` that has to be read: the exported columns plus those the predicates need."""
+        selected = self.select(schema).names
+        return pa.schema(
+            [field for field in schema if field.name in selected or field.name in self.predicate_columns]
+        )
+
+
+# Bytes read from the end of a parquet file to get its footer; larger footers take a second read
+FOOTER_READ_AHEAD = 64 * 1024
+
+
+def _read_rawfile_footer(path):
+    with get_rawfile(path, cache=False) as source:
+        return pq.ParquetFile(source).metadata
+
+
+async def _read_footer(path):
+    """
+    The parquet footer (`FileMetaData`) of the file at `path`, read without fetching any of its row groups. Local
+    and S3 files are read by the async storage backends, with one ranged read of their tail.
+    """
+    if urlparse(path).scheme.lower() not in ("file", "s3"):
+        return await run_in_threadpool(_read_rawfile_footer, path)
+
+    path, info = await stat_file(path)
+    storage, size = get_storage(path), info["size"]
+    if size < 12:
+        raise ValueError(f"{path} is not a parquet file")
+    tail = await storage.get(path, max(0, size - FOOTER_READ_AHEAD), size - 1, info["etag"])
+    if tail[-4:] != b"PAR1":
+        raise ValueError(f"{path} is not a parquet file")
+    # The footer ends with its length and the magic bytes
+    footer_size = struct.unpack("<I", tail[-8:-4])[0] + 8
+    if footer_size > len(tail):
+        tail = await storage.get(path, size - footer_size, size - 1, info["etag"])
+    return pq.read_metadata(BytesIO(b"PAR1" + tail[-footer_size:]))
+
+
+def _iter_file_row_groups(path, footer, schema, export_filter, output_schema, loop):
+    """
+    Read the row groups of the parquet file at `path`, whose `footer` has already been read, as Arrow tables of
+    `schema`, filtered by `export_filter` and projected on `output_schema`. The file is only opened once a row
+    group has to be read, through `open_file` on the event loop `loop`.
+    """
+    file_columns = _parquet_columns(footer.schema.to_arrow_schema())
+    if not export_filter.file_may_match(file_columns):
+        return
+    row_groups = [
+        row_group for row_group in range(footer.num_row_groups)
+        if export_filter.row_group_may_match(footer.row_group(row_group))
+    ]
+    if not row_groups:
+        return
+    read_columns = [column for column in schema.names if column in file_columns]
+    with run_from_thread(loop, open_file, path) as source:
+        parquet_file = pq.ParquetFile(source, metadata=footer)
+        for row_group in row_groups:
+            table = _align_table(parquet_file.read_row_group(row_group, columns=read_columns), schema)
+            table = export_filter.filter_table(table)
+            yield table.select(output_schema.names) if table.schema != output_schema else table
+
+
+_PREFETCH_END = object()
+
+
+def _prefetch(producers, window, depth):
+    """
+    Yield everything produced by each of `producers` (callables returning iterators) in order, while up to
+    `window` of them run ahead on worker threads, each buffering at most `depth` items.
+
+    Every producer is consumed by a single thread, so producers reading from a file object don't need to share it.
+    """
+    stop = threading.Event()
+
+    def put(output, entry):
+        # Give up when the consumer has gone away instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                output.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(producer, output):
+        items = producer()
+        try:
+            for item in items:
+                if not put(output, (item, None)):
+                    return
+        except BaseException as e:
+            put(output, (_PREFETCH_END, e))
+        else:
+            put(output, (_PREFETCH_END, None))
+        finally:
+            # Release whatever the producer holds open, also when the consumer stopped early
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+
+    producers = iter(producers)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=window, thread_name_prefix="export-prefetch")
+
+    def start_next():
+        producer = next(producers, None)
+        if producer is not None:
+            output = queue.Queue(maxsize=depth)
+            executor.submit(propagate_route(run), producer, output)
+            pending.append(output)
+
+    try:
+        for _ in range(window):
+            start_next()
+        while pending:
+            output = pending.popleft()
+            while True:
+                item, error = output.get()
+                if item is _PREFETCH_END:
+                    if error is not None:
+                        raise error
+                    break
+                yield item
+            start_next()
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+def _iter_row_groups(paths, footers, schema, export_filter, output_schema, loop):
+    """
+    Read the row groups of every file in turn, as `_iter_file_row_groups` does, with the next
+    EXPORT_PREFETCH_FILES files opened, fetched and decoded concurrently while the current one is written out.
+    """
+    return _prefetch(
+        [
+            functools.partial(_iter_file_row_groups, path, footer, schema, export_filter, output_schema, loop)
+            for path, footer in zip(paths, footers)
+        ],
+        window=settings.EXPORT_PREFETCH_FILES,
+        depth=settings.EXPORT_PREFETCH_ROW_GROUPS,
     )
-    if wide_format == "true":
-        df_wide = pd.pivot(df, index=None, columns='feature', values='value')  # Reshape from long to wide
-        df = df.drop(['feature', 'value'], axis=1)
-        df = pd.merge(df, df_wide, left_index=True, right_index=True)
 
-    # Prepare for writing CSV to a temporary buffer
-    buffer = StringIO()
-    writer = csv.writer(buffer)
 
-    # Write out the header row
-    writer.writerow(df.columns)
+def _spill_wide_partitions(tables, total_rows, key, directory):
+    """
+    First pass of the wide export: hash-partition the `key`, `feature` and `value` columns of the long `tables`
+    by `key` into pickled chunks under `directory`, so each partition can later be pivoted on its own.
+
+    Returns the number of partitions and the sorted features, which become the wide columns.
+    """
+    partitions = max(1, -(-total_rows // settings.WIDE_EXPORT_PARTITION_ROWS))
+    features = set()
+    spill_files = [open(os.path.join(directory, f"{partition}.pickle"), "wb") for partition in range(partitions)]
+    try:
+        for table in tables:
+            df = table.to_pandas()
+            df = df.reindex(columns=key + ["feature", "value"], copy=False)
+            df = df[df["feature"].notna()]
+            # Files can disagree on a column's type when it is empty in some of them, so keys are hashed as objects
+            df[key] = df[key].astype(object).where(df[key].notna(), None)
+            features.update(df["feature"].unique())
+
+            partition_ids = pd.util.hash_pandas_object(df[key], index=False).values % partitions
+            for partition, chunk in df.groupby(partition_ids):
+                pickle.dump(chunk, spill_files[partition], protocol=pickle.HIGHEST_PROTOCOL)
+    finally:
+        for spill_file in spill_files:
+            spill_file.close()
+    return partitions, sorted(features, key=str)
+
+
+def _wide_schema(schema, key, features):
+    """Export schema of the wide layout: the `key` columns followed by one `value`-typed column per feature."""
+    value_type = schema.field("value").type if "value" in schema.names else pa.float64()
+    return pa.schema(
+        [schema.field(column) for column in key]
+        + [pa.field(str(feature), value_type) for feature in features]
+    )
+
+
+def _iter_pickled(path):
+    """The objects pickled one after another into the file at `path`."""
+    with open(path, "rb") as spill_file:
+        while True:
+            try:
+                yield pickle.load(spill_file)
+            except EOFError:
+                return
+
+
+def _sort_by_key(df, key):
+    return df.sort_values(key, na_position="first", kind="mergesort")
+
+
+def _merge_sorted(sources, key):
+    """
+    Merge iterators of DataFrames, each sorted by `key`, into DataFrames sorted by `key` across all of them. A key
+    appears in at most one source. Only the current DataFrame of each source is held in memory.
+    """
+    sources = list(sources)
+    active = set(range(len(sources)))
+    buffers = {}
+    while True:
+        for index in sorted(active - buffers.keys()):
+            df = next(sources[index], None)
+            if df is None:
+                active.discard(index)
+            else:
+                buffers[index] = df
+        if not buffers:
+            return
+        if len(buffers) == 1:
+            (index, df), = buffers.items()
+            yield df
+            yield from sources[index]
+            return
+
+        # Nothing unread sorts before the smallest of the buffers' last rows, so everything up to it is output
+        lasts = pd.concat([df.iloc[[-1]].assign(_source=index) for index, df in buffers.items()])
+        bound = _sort_by_key(lasts, key)["_source"].iloc[0]
+        merged = pd.concat([df.assign(_source=index) for index, df in buffers.items()])
+        merged = _sort_by_key(merged, key).reset_index(drop=True)
+        end = merged.index[merged["_source"] == bound][-1] + 1
+        yield merged.iloc[:end].drop(columns="_source")
+        buffers = {
+            index: df.drop(columns="_source") for index, df in merged.iloc[end:].groupby("_source", sort=False)
+        }
+
+
+def _iter_wide_tables(directory, partitions, key, schema):
+    """
+    Pivot the spilled partitions from long to wide, as Arrow tables with the wide `schema` sorted by `key`. Each
+    partition is pivoted and sorted on its own and spilled back in slices, which are then merged in key order.
+    """
+    slice_rows = max(1, settings.WIDE_EXPORT_PARTITION_ROWS // partitions)
+    sorted_partitions = []
+    for partition in range(partitions):
+        chunks = list(_iter_pickled(os.path.join(directory, f"{partition}.pickle")))
+        if not chunks:
+            continue
+        df = pd.concat(chunks, ignore_index=True)
+        del chunks
+
+        wide = _sort_by_key(
+            df.groupby(key + ["feature"], dropna=False, sort=False)["value"]
+            .first()
+            .unstack("feature")
+            .reset_index(),
+            key,
+        )
+        del df
+        wide.columns = [str(column) for column in wide.columns]
+        wide = wide.reindex(columns=schema.names, copy=False)
+
+        wide_path = os.path.join(directory, f"{partition}.wide.pickle")
+        with open(wide_path, "wb") as spill_file:
+            for start in range(0, len(wide), slice_rows):
+                pickle.dump(wide.iloc[start:start + slice_rows], spill_file, protocol=pickle.HIGHEST_PROTOCOL)
+        sorted_partitions.append(_iter_pickled(wide_path))
+        del wide
+
+    for wide in _merge_sorted(sorted_partitions, key):
+        yield _align_table(pa.Table.from_pandas(wide, preserve_index=False), schema)
+
+
+def _rechunk(blocks, chunk_size):
+    """Coalesce and split the byte strings in `blocks` into chunks of `chunk_size` (the last one may be shorter)."""
+    pending = bytearray()
+    for block in blocks:
+        pending += block
+        if len(pending) >= chunk_size:
+            end = len(pending) - len(pending) % chunk_size
+            with memoryview(pending) as view:
+                for offset in range(0, end, chunk_size):
+                    yield bytes(view[offset:offset + chunk_size])
+            del pending[:end]
+    if pending:
+        yield bytes(pending)
+
+
+class _DrainableSink(io.RawIOBase):
+    """Write-only file that hands back what has been written since the last `drain()`, to stream a writer's output."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _encode_csv(tables, schema):
+    """Encode rows with Arrow's columnar CSV writer, header first."""
+    header = StringIO()
+    # Arrow ends rows with a bare newline, so the header has to as well
+    csv.writer(header, lineterminator="\n").writerow(schema.names)
+    yield header.getvalue().encode()
+
+    write_options = pacsv.WriteOptions(include_header=False)
+    for table in tables:
+        sink = pa.BufferOutputStream()
+        pacsv.write_csv(_csv_table(table), sink, write_options=write_options)
+        yield sink.getvalue().to_pybytes()
 
-    yield buffer.getvalue()
-    buffer.seek(0)  # To clear the buffer we need to seek back to the start and truncate
-    buffer.truncate()
 
-    # Iterate over dataframe tuples, writing each one out as a CSV line one at a time
-    for record in df.itertuples(index=False, name=None):
-        writer.writerow(str(i) for i in record)
-        yield buffer.getvalue()
-        buffer.seek(0)
-        buffer.truncate()
+def _encode_parquet(tables, schema):
+    """Write the tables as the row groups of a single parquet file."""
+    sink = _DrainableSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    for table in tables:
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _encode_arrow(tables, schema):
+    """Write the tables as the record batches of an Arrow IPC stream."""
+    sink = _DrainableSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for table in tables:
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _encode_ndjson(tables, schema):
+    """Write one JSON object per row; NaN and nulls become null."""
+    for table in tables:
+        if table.num_rows:
+            records = table.to_pandas().to_json(orient="records", lines=True, double_precision=15)
+            yield records.rstrip("\n").encode() + b"\n"
+
+
+EXPORT_ENCODERS = {
+    "csv": _encode_csv,
+    "parquet": _encode_parquet,
+    "arrow": _encode_arrow,
+    "ndjson": _encode_ndjson,
+}
+
+
+async def stream_data_paths(data_paths, export_format="csv", wide_format='false', export_filter=None):
+    """
+    Stream the concatenated parquet outputs in `data_paths` as CSV, parquet, an Arrow IPC stream or NDJSON
+    (see `EXPORT_ENCODERS`), optionally pivoted to the wide layout and restricted by an `ExportFilter`.
+    """
+    encode = EXPORT_ENCODERS[export_format]
+    export_filter = export_filter or ExportFilter()
+
+    # Only the parquet footers are read up front, concurrently on the event loop. Files are opened as the prefetch
+    # window reaches them and their row groups read one at a time with ranged reads made by the async storage
+    # backends, so memory is bounded by a few row groups (or a wide partition) and the first bytes go out without
+    # waiting for whole objects to download, however large the run is.
+    paths = [storage_url(path) for path in data_paths]
+    footers = await asyncio.gather(*(_read_footer(path) for path in paths))
+    loop = asyncio.get_running_loop()
+    spill_directory = None
+    try:
+        schema = _export_schema(footers)
+
+        # Rows sharing a key (timestamp, location and any qualifiers) become one row with a column per feature.
+        # They are partitioned by key on local disk first, then each partition is pivoted and sorted on its own and
+        # the partitions are merged in key order. Data without key or feature columns is exported as it is.
+        key = [column for column in schema.names if column not in ("feature", "value")]
+        if wide_format == "true" and key and "feature" in schema.names:
+            long_tables = _iter_row_groups(paths, footers, schema, export_filter, schema, loop)
+            total_rows = sum(footer.num_rows for footer in footers)
+            spill_directory = tempfile.TemporaryDirectory()
+            partitions, features = await run_in_threadpool(
+                _spill_wide_partitions, long_tables, total_rows, key, spill_directory.name
+            )
+            wide_schema = _wide_schema(schema, key, features)
+            schema = export_filter.select(wide_schema)
+            tables = (
+                table.select(schema.names)
+                for table in _iter_wide_tables(spill_directory.name, partitions, key, wide_schema)
+            )
+        else:
+            read_schema = export_filter.read_schema(schema)
+            schema = export_filter.select(schema)
+            tables = _iter_row_groups(paths, footers, read_schema, export_filter, schema, loop)
+
+        # Batches are encoded off the event loop and sent in fixed-size chunks
+        chunks = _rechunk(encode(tables, schema), settings.EXPORT_CHUNK_SIZE)
+        while True:
+            chunk = await run_in_threadpool(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        if spill_directory is not None:
+            spill_directory.cleanup()
+
+
+class ArchiveStream:
+    """
+    Writes files into a zip or tar archive produced as a stream: `add` and `close` return generators of the
+    archive's bytes, drained after every chunk, so neither the archive nor an entry is ever held in memory.
+    """
+
+    def __init__(self, archive_format):
+        self.archive_format = archive_format
+        self.sink = _DrainableSink()
+        if archive_format == "zip":
+            # The sink can't seek, so entries are written with data descriptors after their contents
+            self.archive = zipfile.ZipFile(
+                self.sink, "w", compresslevel=settings.COMPRESSION_LEVELS.get("deflate")
+            )
+
+    def add(self, name, fileobj, size, compress=False):
+        """Add `size` bytes read from `fileobj` as `name`, deflating them in zip archives when `compress` is set."""
+        chunks = iter(lambda: fileobj.read(settings.EXPORT_CHUNK_SIZE), b"")
+        if self.archive_format == "zip":
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            with self.archive.open(info, "w", force_zip64=True) as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield self.sink.drain()
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = size
+            info.mtime = int(time.time())
+            self.sink.write(info.tobuf(tarfile.PAX_FORMAT))
+            for chunk in chunks:
+                self.sink.write(chunk)
+                yield self.sink.drain()
+            # Entries are padded to whole blocks
+            self.sink.write(tarfile.NUL * (-size % tarfile.BLOCKSIZE))
+        yield self.sink.drain()
+
+    def close(self):
+        if self.archive_format == "zip":
+            self.archive.close()
+        else:
+            self.sink.write(tarfile.NUL * tarfile.BLOCKSIZE * 2)
+        yield self.sink.drain()
+
+
+class _BrotliCompressor:
+    """Gives brotli's compressor the `compress`/`flush` interface of the zlib and zstandard ones."""
+
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+# Content-Encodings responses can be compressed with, in order of preference when the client accepts several
+CONTENT_ENCODINGS = {
+    "zstd": lambda level: zstandard.ZstdCompressor(level=level).compressobj(),
+    "br": _BrotliCompressor,
+    "gzip": lambda level: zlib.compressobj(level, zlib.DEFLATED, 31),
+    "deflate": lambda level: zlib.compressobj(level),
+}
+
+# Compression is CPU bound, so it runs on its own threads rather than the event loop or the request threadpool
+_compression_executor = ThreadPoolExecutor(
+    max_workers=settings.COMPRESSION_WORKERS, thread_name_prefix="compression"
+)
+
+
+def parse_accept_encoding(accept_encoding):
+    """Map each coding in an Accept-Encoding header to its q-value."""
+    accepted = {}
+    for item in (accept_encoding or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.lower()] = q
+    return accepted
+
+
+def accepts_encoding(accept_encoding, encoding):
+    accepted = parse_accept_encoding(accept_encoding)
+    return accepted.get(encoding, accepted.get("*", 0)) > 0
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Pick the Content-Encoding for a response from its request's Accept-Encoding, or None to send it uncompressed.
+    The client's highest q-value wins, ties going to the order of CONTENT_ENCODINGS.
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    candidates = [
+        (accepted.get(encoding, accepted.get("*", 0)), -rank, encoding)
+        for rank, encoding in enumerate(CONTENT_ENCODINGS)
+        if settings.COMPRESSION_LEVELS.get(encoding) is not None
+    ]
+    q, _, encoding = max(candidates, default=(0, 0, None))
+    return encoding if q > 0 else None
 
 
-async def compress_stream(content):
-    compressor = compressobj()
+async def compress_stream(content, encoding="deflate"):
+    """Compress an async byte stream with `encoding`, off the event loop at the configured level."""
+    compressor = CONTENT_ENCODINGS[encoding](settings.COMPRESSION_LEVELS[encoding])
+    loop = asyncio.get_running_loop()
     async for buff in content:
-        yield compressor.compress(buff.encode())
-    yield compressor.flush()
+        compressed = await loop.run_in_executor(_compression_executor, compressor.compress, buff)
+        if compressed:
+            yield compressed
+    yield await loop.run_in_executor(_compression_executor, compressor.flush)
 
@@ -0,0 +1,67 @@
+import os
+import re
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# Settings are read when `src` is imported, so the environment has to be in place first
+STORAGE_DIR = tempfile.mkdtemp(prefix="dojo-storage-")
+os.environ.update(
+    ELASTICSEARCH_URL="localhost",
+    DMC_URL="localhost",
+    DMC_USER="dojo",
+    DMC_PASSWORD="dojo",
+    DMC_LOCAL_DIR=STORAGE_DIR,
+    DOJO_URL="http://localhost",
+    REDIS_HOST="localhost",
+    DATASET_STORAGE_BASE_URL=f"file://{STORAGE_DIR}/",
+    STORAGE_SIGNING_SECRET="test-secret",
+    AWS_DEFAULT_REGION="us-east-1",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves `content` with byte range support, recording the Range header of every GET."""
+
+    content = b""
+    ranges = []
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length, content_range=None):
+        self.send_response(status)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", '"v1"')
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(self.content))
+
+    def do_GET(self):
+        self.ranges.append(self.headers.get("Range"))
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match is None:
+            self._headers(200, len(self.content))
+            self.wfile.write(self.content)
+            return
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(self.content) - 1
+        self._headers(206, end - start + 1, f"bytes {start}-{end}/{len(self.content)}")
+        self.wfile.write(self.content[start:end + 1])
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
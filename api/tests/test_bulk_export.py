@@ -0,0 +1,57 @@
+import pytest
+from fastapi import HTTPException
+
+from src import dojo
+from src.settings import settings
+from validation import DojoSchema
+
+
+class FakeElasticsearch:
+    """Serves `runs` a page per request, the way a search followed by scrolls does."""
+
+    def __init__(self, runs):
+        self.runs = runs
+        self.queries = []
+        self.cleared = []
+
+    def _page(self, start, size):
+        hits = [{"_source": run} for run in self.runs[start:start + size]]
+        return {"_scroll_id": str(start + size), "hits": {"hits": hits}}
+
+    def search(self, index, body, scroll, size):
+        self.queries.append(body)
+        self.size = size
+        return self._page(0, size)
+
+    def scroll(self, scroll_id, scroll):
+        return self._page(int(scroll_id), self.size)
+
+    def clear_scroll(self, scroll_id):
+        self.cleared.append(scroll_id)
+
+
+def run(run_id, rainfall):
+    return {"id": run_id, "parameters": [{"name": "rainfall", "value": rainfall}]}
+
+
+def test_bulk_export_scrolls_past_runs_filtered_out_by_parameters(monkeypatch):
+    monkeypatch.setattr(settings, "BULK_EXPORT_MAX_RUNS", 2)
+    es = FakeElasticsearch([run("a", "low"), run("b", "low"), run("c", "high"), run("d", "low")])
+    monkeypatch.setattr(dojo, "es", es)
+
+    selection = DojoSchema.BulkRunDownload(model_id="m", parameters={"rainfall": "high"})
+    runs, missing = dojo.bulk_export_runs(selection)
+
+    assert [r["id"] for r in runs] == ["c"]
+    assert missing == []
+    assert {"term": {"parameters.name.keyword": "rainfall"}} in es.queries[0]["query"]["bool"]["filter"]
+    assert es.cleared
+
+
+def test_bulk_export_rejects_selections_over_the_limit(monkeypatch):
+    monkeypatch.setattr(settings, "BULK_EXPORT_MAX_RUNS", 2)
+    monkeypatch.setattr(dojo, "es", FakeElasticsearch([run(run_id, "low") for run_id in "abc"]))
+
+    with pytest.raises(HTTPException) as error:
+        dojo.bulk_export_runs(DojoSchema.BulkRunDownload(model_id="m"))
+    assert error.value.status_code == 400
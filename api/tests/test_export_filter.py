@@ -0,0 +1,26 @@
+import pyarrow as pa
+
+from src.utils import ExportFilter
+
+
+def test_filter_matches_dictionary_encoded_columns():
+    table = pa.table({
+        "feature": pa.array(["rain", "temp", "rain"]).dictionary_encode(),
+        "value": [1.0, 2.0, 3.0],
+    })
+    filtered = ExportFilter(features=["rain", "missing"]).filter_table(table)
+    assert filtered.column("value").to_pylist() == [1.0, 3.0]
+
+
+def test_filter_compares_timestamp_bounds_in_the_column_unit():
+    table = pa.table({
+        "timestamp": pa.array([1000, 2000, 3000], pa.timestamp("ms")),
+        "value": [1.0, 2.0, 3.0],
+    })
+    filtered = ExportFilter(timestamp_gte=2000).filter_table(table)
+    assert filtered.column("value").to_pylist() == [2.0, 3.0]
+
+
+def test_filter_bounds_a_column_cannot_represent_match_nothing():
+    table = pa.table({"timestamp": ["0999", "2020-01-02"], "value": [1.0, 2.0]})
+    assert ExportFilter(timestamp_lte=1000).filter_table(table).num_rows == 0
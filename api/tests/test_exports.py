@@ -0,0 +1,42 @@
+import pandas as pd
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src import dojo
+
+
+class FakeElasticsearch:
+    def __init__(self, run):
+        self.run = run
+
+    def get(self, index, id):
+        return {"_source": self.run}
+
+
+app = FastAPI()
+app.include_router(dojo.router)
+client = TestClient(app)
+
+
+def test_streamed_compression_has_a_weak_etag_and_the_artifact_a_strong_one(tmp_path, monkeypatch):
+    path = tmp_path / "output.parquet"
+    pd.DataFrame({"timestamp": [1, 2], "feature": ["rain", "rain"], "value": [1.0, 2.0]}).to_parquet(path)
+    run = {"data_paths": [f"file://{path}"], "attributes": {"status": "success"}}
+    monkeypatch.setattr(dojo, "es", FakeElasticsearch(run))
+    headers = {"Accept-Encoding": "gzip"}
+
+    streamed = client.get("/dojo/download/csv/runs/etag-run", headers=headers)
+    assert streamed.headers["Content-Encoding"] == "gzip"
+    assert streamed.headers["ETag"].startswith('W/"')
+    assert "Accept-Ranges" not in streamed.headers
+
+    stored = client.get("/dojo/download/csv/runs/etag-run", headers=headers)
+    assert stored.headers["ETag"] == streamed.headers["ETag"][2:]
+    assert stored.headers["Accept-Ranges"] == "bytes"
+    assert stored.text == streamed.text
+
+    ranged = client.get(
+        "/dojo/download/csv/runs/etag-run",
+        headers={**headers, "Range": "bytes=0-3", "If-Range": streamed.headers["ETag"]},
+    )
+    assert ranged.status_code == 200
@@ -0,0 +1,56 @@
+import io
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.concurrency import run_in_threadpool
+
+from conftest import RangeHandler
+from src import metrics
+from src.settings import settings
+from src.utils import get_rawfile, put_rawfile
+
+
+def open_rawfile(path):
+    with get_rawfile(path):
+        pass
+
+
+app = FastAPI()
+
+
+@app.get("/files/{name}")
+async def read_file(name: str):
+    await run_in_threadpool(open_rawfile, f"{settings.DATASET_STORAGE_BASE_URL}metrics/{name}")
+
+
+app.add_middleware(metrics.RouteLabelMiddleware, routes=app.routes)
+client = TestClient(app)
+
+
+def test_storage_operations_are_labelled_with_the_route_and_bytes(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(
+        metrics, "record_storage_operation",
+        lambda operation, backend, seconds, size=None, caller=None: recorded.append((operation, caller, size)),
+    )
+    put_rawfile(f"{settings.DATASET_STORAGE_BASE_URL}metrics/data.csv", io.BytesIO(b"a,b\n1,2\n"))
+
+    assert client.get("/files/data.csv").status_code == 200
+    assert ("open", "test_metrics.read_file", 8) in recorded
+
+
+def test_ranged_reads_record_the_bytes_they_transfer(http_server, monkeypatch):
+    recorded = []
+    monkeypatch.setattr(
+        metrics, "record_storage_operation",
+        lambda operation, backend, seconds, size=None, caller=None: recorded.append((operation, size)),
+    )
+    RangeHandler.content = bytes(range(256)) * 1024
+    RangeHandler.ranges = []
+
+    with get_rawfile(f"http://127.0.0.1:{http_server.server_port}/object", cache=False, read_ahead=4096) as raw_file:
+        raw_file.read(100)
+
+    assert ("open", None) in recorded
+    assert ("get_range", 4096) in recorded
+    assert sum(size for operation, size in recorded if size) == 4096
@@ -0,0 +1,29 @@
+import pandas as pd
+
+from src.settings import settings
+from src.utils import read_parquet_head, sample_parquet
+
+
+def test_parquet_head_keeps_the_range_index(tmp_path):
+    path = tmp_path / "data.parquet"
+    pd.DataFrame({"value": range(10)}, index=pd.RangeIndex(5, 25, 2)).to_parquet(path)
+
+    with open(path, "rb") as source:
+        head = read_parquet_head(source, 3)
+
+    assert list(head.index) == [5, 7, 9]
+    assert list(head["value"]) == [0, 1, 2]
+
+
+def test_parquet_sample_takes_rows_from_batches_of_each_row_group(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "PREVIEW_SAMPLE_CHUNK_ROWS", 7)
+    path = tmp_path / "data.parquet"
+    pd.DataFrame({"value": range(1000)}).to_parquet(path, row_group_size=300)
+
+    with open(path, "rb") as source:
+        sample, missing = sample_parquet([source, None], 50, seed=1)
+
+    assert missing is None
+    assert len(sample) == 50
+    assert sample.index.is_monotonic_increasing
+    assert (sample["value"] == sample.index).all()
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import threading
+
+import pandas as pd
+
+from conftest import RangeHandler
+from src.utils import stream_data_paths
+
+
+def test_https_exports_are_read_with_byte_ranges(http_server):
+    buffer = io.BytesIO()
+    pd.DataFrame({"feature": ["rain"] * 1000, "value": range(1000)}).to_parquet(buffer, row_group_size=100)
+    RangeHandler.content = buffer.getvalue()
+    RangeHandler.ranges = []
+
+    async def collect():
+        url = f"http://127.0.0.1:{http_server.server_port}/output.parquet"
+        return b"".join([chunk async for chunk in stream_data_paths([url], "csv")])
+
+    exported = pd.read_csv(io.BytesIO(asyncio.run(collect())))
+
+    assert exported["value"].tolist() == list(range(1000))
+    assert RangeHandler.ranges and all(RangeHandler.ranges)
+
+
+def test_exports_only_open_the_files_in_the_prefetch_window(tmp_path, monkeypatch):
+    from src import utils
+
+    data_paths = []
+    for index in range(6):
+        path = tmp_path / f"output_{index}.parquet"
+        pd.DataFrame({"feature": ["rain"] * 10, "value": range(10)}).to_parquet(path)
+        data_paths.append(f"file://{path}")
+
+    open_file = utils.open_file
+    monkeypatch.setattr(utils.settings, "EXPORT_PREFETCH_FILES", 2)
+    lock = threading.Lock()
+    open_files = [0]
+    most_open = [0]
+
+    class TrackedFile:
+        def __init__(self, raw_file):
+            self.raw_file = raw_file
+
+        def __getattr__(self, name):
+            return getattr(self.raw_file, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            self.close()
+
+        def close(self):
+            if not self.raw_file.closed:
+                with lock:
+                    open_files[0] -= 1
+            self.raw_file.close()
+
+    async def tracked_open_file(path, *args, **kwargs):
+        with lock:
+            open_files[0] += 1
+            most_open[0] = max(most_open[0], open_files[0])
+        return TrackedFile(await open_file(path, *args, **kwargs))
+
+    monkeypatch.setattr(utils, "open_file", tracked_open_file)
+
+    async def collect():
+        return b"".join([chunk async for chunk in stream_data_paths(data_paths, "csv")])
+
+    exported = pd.read_csv(io.BytesIO(asyncio.run(collect())))
+
+    assert len(exported) == 60
+    assert open_files[0] == 0
+    assert most_open[0] <= 2
+
+
+def test_local_backend_reads_writes_and_lists(tmp_path):
+    from src.storage import local_storage, open_file
+
+    async def round_trip():
+        path = f"file://{tmp_path}/dataset/data.csv"
+        await local_storage.put(path, b"a,b\n1,2\n")
+        await local_storage.put(f"file://{tmp_path}/dataset/copy.csv", io.BytesIO(b"a,b\n3,4\n"))
+        # A deduplicated upload is a reference to its blob
+        await local_storage.put(
+            f"file://{tmp_path}/dataset/ref.csv.ref", f'{{"blob": "{path}", "sha256": "", "size": 8}}'.encode()
+        )
+        with await open_file(f"file://{tmp_path}/dataset/ref.csv") as source:
+            referenced = source.read()
+        return (
+            await local_storage.head(path),
+            await local_storage.get(path, 4, 6),
+            b"".join([chunk async for chunk in local_storage.stream(path, chunk_size=3)]),
+            sorted(entry["name"] for entry in await local_storage.list(f"file://{tmp_path}/dataset")),
+            referenced,
+        )
+
+    head, byte_range, streamed, names, referenced = asyncio.run(round_trip())
+
+    assert head == {"size": 8, "etag": None}
+    assert byte_range == b"1,2"
+    assert streamed == referenced == b"a,b\n1,2\n"
+    assert names == ["copy.csv", "data.csv", "ref.csv.ref"]
+
+
+def test_cache_lookup_only_serves_the_current_version(tmp_path):
+    from src.utils import StorageCache
+
+    cache = StorageCache(str(tmp_path), max_bytes=1024, max_object_bytes=1024)
+    url = "s3://bucket/object"
+    cache.open(url, lambda etag: ('"v1"', 4, lambda fileobj: fileobj.write(b"data"), lambda: None)).close()
+
+    with cache.lookup(url, '"v1"') as cached:
+        assert cached.read() == b"data"
+    assert cache.lookup(url, '"v2"') is None
+    assert cache.lookup("s3://bucket/other", '"v1"') is None
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src import transfers
+from src.settings import settings
+from src.utils import sign_storage_token
+
+app = FastAPI()
+app.include_router(transfers.router)
+client = TestClient(app)
+
+
+@pytest.mark.parametrize("filename", ["../../../../../etc/passwd", "a/b.csv", "..", "a\\b.csv"])
+def test_presign_rejects_filenames_outside_the_dataset(filename):
+    response = client.get("/indicators/abc/download/presign", params={"filename": filename})
+    assert response.status_code == 400
+
+    response = client.post(
+        "/indicators/abc/upload/presign", params={"original_filename": "data.csv", "filename": filename}
+    )
+    assert response.status_code == 400
+
+
+def test_signed_routes_stay_under_the_storage_base(tmp_path):
+    outside = tmp_path / "secret.txt"
+    outside.write_text("secret")
+    escaped = os.path.join(settings.DATASET_STORAGE_BASE_URL, "abc", "..", "..", "..", str(outside).lstrip("/"))
+
+    for path in (f"file://{outside}", escaped):
+        assert client.get(f"/storage/{sign_storage_token(path, 'GET', 60)}").status_code == 403
+        response = client.put(f"/storage/{sign_storage_token(path, 'PUT', 60)}", data=b"overwritten")
+        assert response.status_code == 403
+    assert outside.read_text() == "secret"
+
+
+def test_signed_routes_serve_files_under_the_storage_base():
+    path = os.path.join(settings.DATASET_STORAGE_BASE_URL, "abc", "raw_data.csv")
+    response = client.put(f"/storage/{sign_storage_token(path, 'PUT', 60)}", data=b"a,b\n1,2\n")
+    assert response.status_code == 201
+
+    response = client.get(f"/storage/{sign_storage_token(path, 'GET', 60)}")
+    assert response.status_code == 200
+    assert response.content == b"a,b\n1,2\n"
+
+
+def test_signed_routes_are_unavailable_without_a_secret(monkeypatch):
+    path = os.path.join(settings.DATASET_STORAGE_BASE_URL, "abc", "raw_data.csv")
+    token = sign_storage_token(path, "GET", 60)
+    monkeypatch.setattr(settings, "STORAGE_SIGNING_SECRET", "")
+
+    assert client.get(f"/storage/{token}").status_code == 503
+    response = client.post("/indicators/abc/upload/presign", params={"original_filename": "data.csv"})
+    assert response.status_code == 503
+
+
+def test_unexpanded_signing_secret_is_ignored(monkeypatch):
+    monkeypatch.setenv("STORAGE_SIGNING_SECRET", "${STORAGE_SIGNING_SECRET}")
+    assert type(settings)().STORAGE_SIGNING_SECRET == ""
@@ -0,0 +1,52 @@
+import asyncio
+import io
+import random
+
+import pandas as pd
+
+from src.settings import settings
+from src.utils import stream_data_paths
+
+
+def write_parquet(tmp_path, name, df):
+    path = tmp_path / name
+    df.to_parquet(path, index=False)
+    return f"file://{path}"
+
+
+def export_csv(data_paths, wide_format):
+    async def collect():
+        return b"".join([chunk async for chunk in stream_data_paths(data_paths, "csv", wide_format)])
+
+    return pd.read_csv(io.BytesIO(asyncio.run(collect())))
+
+
+def test_wide_export_is_sorted_by_key_across_partitions(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "WIDE_EXPORT_PARTITION_ROWS", 50)
+    rows = [
+        {"timestamp": timestamp, "country": country, "feature": feature, "value": float(timestamp)}
+        for timestamp in range(40)
+        for country in ("Ethiopia", "Kenya")
+        for feature in ("rain", "temp")
+    ]
+    random.Random(0).shuffle(rows)
+    data_paths = [
+        write_parquet(tmp_path, "a.parquet", pd.DataFrame(rows[:100])),
+        write_parquet(tmp_path, "b.parquet", pd.DataFrame(rows[100:])),
+    ]
+
+    wide = export_csv(data_paths, "true")
+
+    assert list(wide.columns) == ["timestamp", "country", "rain", "temp"]
+    assert len(wide) == 80
+    assert wide[["timestamp", "country"]].equals(
+        wide[["timestamp", "country"]].sort_values(["timestamp", "country"], ignore_index=True)
+    )
+    assert (wide["rain"] == wide["timestamp"]).all()
+
+
+def test_wide_export_without_key_columns_is_left_long(tmp_path):
+    df = pd.DataFrame({"feature": ["rain", "temp"], "value": [1.0, 2.0]})
+    data_paths = [write_parquet(tmp_path, "a.parquet", df)]
+
+    assert export_csv(data_paths, "true").to_dict("list") == {"feature": ["rain", "temp"], "value": [1, 2]}
@@ -259,6 +259,62 @@ class ParameterFormatter(BaseModel):
     )
 
 
+class DownloadFormat(Enum):
+    csv = "csv"
+    parquet = "parquet"
+    arrow = "arrow"
+    ndjson = "ndjson"
+
+
+class ArchiveFormat(Enum):
+    zip = "zip"
+    tar = "tar"
+
+
+class BulkRunDownload(BaseModel):
+    """
+    The runs to export into a single archive: the listed `run_ids`, or else every run of `model_id` or
+    `model_name` whose parameters match `parameters`.
+    """
+
+    run_ids: List[str] = Field(
+        [],
+        title="Run IDs",
+        description="The runs to export",
+    )
+    model_id: Optional[str] = Field(
+        None,
+        title="Model ID",
+        description="Export the runs of this model when no run IDs are given",
+    )
+    model_name: Optional[str] = Field(
+        None,
+        title="Model Name",
+        description="Export the runs of this model when no run IDs are given",
+    )
+    parameters: Dict[str, str] = Field(
+        {},
+        title="Parameter Filters",
+        description="Only export runs whose parameters match every value given (strings match case-insensitively by substring)",
+        example={"rainfall_multiplier": "0.5"},
+    )
+    format: DownloadFormat = Field(
+        DownloadFormat.csv,
+        title="Download Format",
+        description="Format of each run's file",
+    )
+    wide_format: bool = Field(
+        False,
+        title="Wide Format",
+        description="Pivot each run's features into columns",
+    )
+    archive: ArchiveFormat = Field(
+        ArchiveFormat.zip,
+        title="Archive Format",
+        description="Type of the archive holding the run files and their manifest",
+    )
+
+
 class StatusAction(Enum):
     """
     The status actions are options that decide how to handle the status of
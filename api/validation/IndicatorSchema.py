@@ -481,3 +481,14 @@ class DateValidationResponseSchema(BaseModel):
         description="Indicates if format provided (and returned) matches the values sent in",
         examples=[True, False],
     )
+
+
+class DataPathsUpdateSchema(BaseModel):
+    add: List[str] = Field(
+        [],
+        description="Processed file URLs to put at the front of the dataset's data_paths",
+    )
+    remove: List[str] = Field(
+        [],
+        description="Processed file URLs to drop from the dataset's data_paths",
+    )
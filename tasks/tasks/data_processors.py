@@ -2,14 +2,21 @@ from os import mkdir
 import json
 import os
 import logging
+import re
 import requests
 import shutil
+import tempfile
+import time
+from urllib.parse import urlparse
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from geotime_classify import geotime_classify as gc
 import numpy as np
 
-from utils import get_rawfile
+from utils import data_file_url, download_rawfile, get_rawfile, put_rawfile
 from settings import settings
 
 logging.basicConfig()
@@ -61,3 +68,163 @@ def histogram_data(x):
         logging.info("Trying to build histogram for column")
         hist, bins = np.histogram(x_mod)
         return {"values": hist, "bins": bins}
+
+
+# Compacted files are sorted on these columns so each row group covers a narrow range of features and times
+COMPACTION_SORT_COLUMNS = ["feature", "timestamp", "country", "admin1", "admin2", "admin3"]
+
+
+def _conform(table, schema):
+    """Give `table` the columns of `schema`, in order, filling the ones it lacks with nulls."""
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, type=field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _feature_partitions(parquet_files, max_rows):
+    """
+    Split the distinct features of `parquet_files`, in sort order, into consecutive partitions of about `max_rows`
+    rows. Returns the sorted features and, for each of them plus a trailing entry for null features, its partition.
+    """
+    counts = {}
+    for parquet_file in parquet_files:
+        for group in range(parquet_file.num_row_groups):
+            column = parquet_file.read_row_group(group, columns=["feature"]).column("feature")
+            value_counts = pc.value_counts(column)
+            for value, count in zip(
+                value_counts.field("values").to_pylist(), value_counts.field("counts").to_pylist()
+            ):
+                counts[value] = counts.get(value, 0) + count
+
+    features = sorted(feature for feature in counts if feature is not None)
+    partition_of, partition, rows = [], 0, 0
+    for feature in features:
+        if rows and rows + counts[feature] > max_rows:
+            partition, rows = partition + 1, 0
+        partition_of.append(partition)
+        rows += counts[feature]
+    # Null features sort last
+    partition_of.append(partition)
+    return features, np.array(partition_of)
+
+
+def _compact_files(local_paths, output_path, workdir):
+    """
+    Merge the parquet files at `local_paths` into one file at `output_path`, sorted on `COMPACTION_SORT_COLUMNS`.
+
+    Row groups are streamed one at a time into spill files holding consecutive ranges of features, and each spill
+    file is then sorted on its own and appended to the output, so memory is bounded by a partition rather than the
+    whole dataset. Returns the number of rows written.
+    """
+    parquet_files = [pq.ParquetFile(path) for path in local_paths]
+    schema = pa.unify_schemas([parquet_file.schema_arrow for parquet_file in parquet_files])
+    sort_keys = [(column, "ascending") for column in COMPACTION_SORT_COLUMNS if column in schema.names]
+
+    if "feature" in schema.names:
+        features, partition_of = _feature_partitions(parquet_files, settings.COMPACTION_PARTITION_ROWS)
+        value_set = pa.array(features, type=schema.field("feature").type)
+    else:
+        partition_of = np.array([0])
+
+    spills = {}
+    try:
+        for parquet_file in parquet_files:
+            for group in range(parquet_file.num_row_groups):
+                table = _conform(parquet_file.read_row_group(group), schema)
+                if "feature" in schema.names:
+                    positions = pc.fill_null(pc.index_in(table.column("feature"), value_set=value_set), len(features))
+                    partitions = partition_of[positions.to_numpy()]
+                else:
+                    partitions = np.zeros(table.num_rows, dtype=int)
+                for partition in np.unique(partitions):
+                    if partition not in spills:
+                        spills[partition] = pq.ParquetWriter(
+                            os.path.join(workdir, f"partition_{partition}.parquet"), schema
+                        )
+                    spills[partition].write_table(table.filter(pa.array(partitions == partition)))
+    finally:
+        for writer in spills.values():
+            writer.close()
+
+    num_rows = 0
+    with pq.ParquetWriter(output_path, schema, compression="gzip") as writer:
+        for partition in sorted(spills):
+            spill_path = os.path.join(workdir, f"partition_{partition}.parquet")
+            table = pq.read_table(spill_path)
+            os.remove(spill_path)
+            if sort_keys:
+                table = table.take(pc.sort_indices(table, sort_keys=sort_keys))
+            writer.write_table(table, row_group_size=settings.PARQUET_ROW_GROUP_SIZE)
+            num_rows += table.num_rows
+    return num_rows
+
+
+def compact_dataset(context, *args, **kwargs):
+    """
+    Merge the processed parquet files of a dataset built from appended uploads (`{uuid}_N.parquet.gzip`, and
+    their `_str` counterparts) into one sorted, row-grouped file per value type, then switch the dataset's
+    `data_paths` over to the compacted files in a single update.
+
+    The source files are left in place so readers that already resolved the old `data_paths` can finish.
+    Returns the dataset's `data_paths` after compaction.
+    """
+    uuid = context["uuid"]
+    api_url = os.environ.get("DOJO_HOST")
+    # The job context can be stale if another append finished after it was enqueued
+    dataset = requests.get(f"{api_url}/indicators/{uuid}").json()
+    data_paths = dataset.get("data_paths") or []
+
+    groups = {"": [], "_str": []}
+    for data_path in data_paths:
+        match = re.search(rf"{uuid}(_str)?(_\d+|_compacted_\d+)?\.parquet\.gzip$", data_path)
+        if match:
+            groups[match.group(1) or ""].append(data_path)
+    groups = {value_type: paths for value_type, paths in groups.items() if len(paths) > 1}
+    if not groups:
+        logging.info(f"Nothing to compact for {uuid}")
+        return data_paths
+
+    generation = int(time.time())
+    compacted = {}
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        for value_type, paths in groups.items():
+            local_paths = []
+            for index, data_path in enumerate(paths):
+                source_path = os.path.join(
+                    settings.DATASET_STORAGE_BASE_URL, uuid, os.path.basename(urlparse(data_path).path)
+                )
+                local_path = os.path.join(tmpdirname, f"source_{index}.parquet.gzip")
+                download_rawfile(source_path, local_path)
+                local_paths.append(local_path)
+
+            local_output = os.path.join(tmpdirname, f"compacted{value_type}.parquet.gzip")
+            num_rows = _compact_files(local_paths, local_output, tmpdirname)
+            for local_path in local_paths:
+                os.remove(local_path)
+
+            dest_path = os.path.join(
+                settings.DATASET_STORAGE_BASE_URL,
+                uuid,
+                f"{uuid}{value_type}_compacted_{generation}.parquet.gzip",
+            )
+            with open(local_output, "rb") as fileobj:
+                put_rawfile(path=dest_path, fileobj=fileobj)
+            os.remove(local_output)
+            compacted[value_type] = data_file_url(dest_path)
+            logging.info(f"Compacted {len(paths)} files of {uuid} into {dest_path} ({num_rows} rows)")
+
+    # Only data_paths is changed, and in place, so paths appended and metadata edited while compacting are kept
+    response = requests.patch(
+        f"{api_url}/indicators/{uuid}/data_paths",
+        json={
+            "add": list(compacted.values()),
+            "remove": [data_path for paths in groups.values() for data_path in paths],
+        },
+    )
+    response.raise_for_status()
+
+    return response.json()["data_paths"]
@@ -10,7 +10,7 @@ from raster2xyz.raster2xyz import Raster2xyz
 
 from mixmasta import mixmasta as mix
 from base_annotation import BaseProcessor
-from utils import DATASET_STORAGE_BASE_URL, get_rawfile, put_rawfile
+from utils import DATASET_STORAGE_BASE_URL, download_rawfile, put_rawfile
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.DEBUG)
@@ -126,13 +126,10 @@ def file_conversion(context, filename=None):
     file_metadata = context["annotations"]["metadata"]["files"][filename]
 
     raw_path = os.path.join(DATASET_STORAGE_BASE_URL, uuid, filename)
-    raw_file = get_rawfile(raw_path)
 
     with tempfile.TemporaryDirectory() as tmpdirname:
         local_file_fp = os.path.join(tmpdirname, filename)
-        with open(local_file_fp, 'wb') as local_file:
-            for chunk in raw_file:
-                local_file.write(chunk)
+        download_rawfile(raw_path, local_file_fp)
 
         df = processor.run(context=file_metadata, fp=local_file_fp)
 
@@ -4,11 +4,10 @@ import os
 import re
 import requests
 import shutil
-from urllib.parse import urlparse
 
 import pandas as pd
 
-from utils import get_rawfile, put_rawfile
+from utils import data_file_url, download_rawfile, put_rawfile
 from mixmasta import mixmasta as mix
 from base_annotation import BaseProcessor
 from settings import settings
@@ -110,9 +109,7 @@ def run_mixmasta(context, filename=None):
 
     rawfile_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, uuid, filename)
 
-    raw_file_obj = get_rawfile(rawfile_path)
-    with open(f"{datapath}/{filename}", "wb") as f:
-        f.write(raw_file_obj.read())
+    download_rawfile(rawfile_path, f"{datapath}/{filename}")
 
     # Writing out the annotations because mixmasta needs a filepath to this data.
     # Should probably change mixmasta down the road to accept filepath AND annotations objects.
@@ -144,12 +141,8 @@ def run_mixmasta(context, filename=None):
             dest_file_path = os.path.join(dest_path, f"{file_root}{file_suffix}.parquet.gzip")
             with open(os.path.join(datapath, local_file), "rb") as fileobj:
                 put_rawfile(path=dest_file_path, fileobj=fileobj)
-            if dest_file_path.startswith("s3:"):
-                # "https://jataware-world-modelers.s3.amazonaws.com/dev/indicators/6c9c996b-a175-4fa6-803c-e39b24e38b6e/6c9c996b-a175-4fa6-803c-e39b24e38b6e.parquet.gzip"
-                location_info = urlparse(dest_file_path)
-                data_files.append(f"https://{location_info.netloc}.s3.amazonaws.com{location_info.path}")
-            else:
-                data_files.append(dest_file_path)
+            # "https://jataware-world-modelers.s3.amazonaws.com/dev/indicators/6c9c996b-a175-4fa6-803c-e39b24e38b6e/6c9c996b-a175-4fa6-803c-e39b24e38b6e.parquet.gzip"
+            data_files.append(data_file_url(dest_file_path))
 
     # Final cleanup of temp directory
     shutil.rmtree(datapath)
@@ -287,9 +280,7 @@ def run_model_mixmasta(context, *args, **kwargs):
     # Copy raw data file into rq-worker
     # Could change mixmasta to accept file-like objects as well as filepaths.
     # rawfile_path = os.path.join(settings.DATASET_STORAGE_BASE_URL, filename)
-    raw_file_obj = get_rawfile(sample_path)
-    with open(f"{localpath}/raw_data.csv", "wb") as f:
-        f.write(raw_file_obj.read())
+    download_rawfile(sample_path, f"{localpath}/raw_data.csv")
 
     # Writing out the annotations because mixmasta needs a filepath to this data.
     # Should probably change mixmasta down the road to accept filepath AND annotations objects.
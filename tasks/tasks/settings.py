@@ -26,6 +26,35 @@ class Settings(BaseSettings):
 
     UVICORN_RELOAD: bool = False
 
+    # Size of the read-ahead buffer used when streaming objects out of S3 with ranged GETs
+    S3_READ_AHEAD_BYTES: int = 8 * 1024 * 1024
+
+    # Shared S3 client and transfer tuning
+    S3_MAX_POOL_CONNECTIONS: int = 32
+    S3_MAX_ATTEMPTS: int = 5
+    S3_DOWNLOAD_CHUNKSIZE: int = 16 * 1024 * 1024
+    S3_DOWNLOAD_CONCURRENCY: int = 8
+
+    # Uploads are copied in chunks of this size for local storage and sent as concurrent multipart uploads to S3
+    STORAGE_COPY_CHUNKSIZE: int = 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE: int = 16 * 1024 * 1024
+    S3_MULTIPART_CONCURRENCY: int = 4
+    # Number of sub-prefixes listed in parallel by iter_files
+    STORAGE_LIST_CONCURRENCY: int = 8
+    # Log every storage operation (latency, bytes, backend and caller) as a JSON line
+    STORAGE_METRICS_LOG: bool = False
+
+    # Local disk cache for remote dataset and run files, revalidated by ETag. Set the size to 0 to disable it.
+    STORAGE_CACHE_DIR: str = "/tmp/dojo-storage-cache"
+    STORAGE_CACHE_MAX_BYTES: int = 2 * 1024 * 1024 * 1024
+    STORAGE_CACHE_MAX_OBJECT_BYTES: int = 512 * 1024 * 1024
+
+    # Rows per row group when compacting a dataset's processed parquet files
+    PARQUET_ROW_GROUP_SIZE: int = 128 * 1024
+    # Rows sorted in memory at a time when compacting: consecutive features are grouped into partitions of about
+    # this size (a single feature with more rows is still sorted on its own)
+    COMPACTION_PARTITION_ROWS: int = 1000 * 1000
+
     UAZ_URL: str = ""
     UAZ_THRESHOLD: str = ""
     UAZ_HITS: str = ""
@@ -1,70 +1,592 @@
+import functools
+import hashlib
+import io
+import json
 import time
 import os
-from io import BytesIO
+import shutil
 import tempfile
+import sys
+import threading
+from contextlib import contextmanager
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import logging
 
 import botocore
 import boto3
+import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from settings import settings
 
 # S3 OBJECT
-s3 = boto3.client("s3")
+# One session and one pooled client are shared by every storage helper in the process; the pool has to be
+# at least as large as the transfer concurrency or parallel parts just queue for a connection.
+s3_session = boto3.session.Session()
+s3 = s3_session.client(
+    "s3",
+    config=Config(
+        max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+        retries={"max_attempts": settings.S3_MAX_ATTEMPTS, "mode": "standard"},
+    ),
+)
+
+# Large objects are uploaded in concurrent multipart chunks; only a handful of parts are ever held in memory
+upload_config = TransferConfig(
+    multipart_threshold=settings.S3_MULTIPART_CHUNKSIZE,
+    multipart_chunksize=settings.S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=settings.S3_MULTIPART_CONCURRENCY,
+)
+# Not exposed by boto3's constructor, but honoured by s3transfer when reading non-seekable streams
+upload_config.max_in_memory_upload_chunks = settings.S3_MULTIPART_CONCURRENCY
+
+# Objects above the threshold are downloaded as parallel ranged GETs
+download_config = TransferConfig(
+    multipart_threshold=settings.S3_DOWNLOAD_CHUNKSIZE,
+    multipart_chunksize=settings.S3_DOWNLOAD_CHUNKSIZE,
+    max_concurrency=settings.S3_DOWNLOAD_CONCURRENCY,
+)
 DATASET_STORAGE_BASE_URL = os.environ.get("DATASET_STORAGE_BASE_URL")
 
 
-def get_rawfile(path):
+def _caller():
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get("__name__") in (__name__, "contextlib"):
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    return f"{frame.f_globals.get('__name__', '')}.{frame.f_code.co_name}"
+
+
+@contextmanager
+def storage_timer(operation, path):
+    """
+    Time the storage operation run inside the block and, if STORAGE_METRICS_LOG is set, log it as a structured
+    line. The block can set `stats["bytes"]` to record the amount of data it moved.
+    """
+    caller = _caller()
+    stats = {"bytes": None}
+    start = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        if settings.STORAGE_METRICS_LOG:
+            logging.info(
+                json.dumps(
+                    {
+                        "event": "storage_operation",
+                        "operation": operation,
+                        "backend": urlparse(path).scheme.lower() or "file",
+                        "caller": caller,
+                        "seconds": round(time.perf_counter() - start, 6),
+                        "bytes": stats["bytes"],
+                    }
+                )
+            )
+
+
+class S3RangeReader(io.RawIOBase):
+    """
+    Read-only, seekable file-like view of an S3 object.
+
+    Bytes are fetched with ranged GETs as the caller reads them instead of downloading the whole object up
+    front. Wrap it in an `io.BufferedReader` (as `get_rawfile` does) to get a read-ahead buffer, so that
+    parsers issuing many small reads only cost one request per buffer fill. Every range request is pinned to
+    the ETag seen when the reader was opened so a concurrent overwrite can't produce a mixed read.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        head = s3.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+        self._position = 0
+
+    @property
+    def name(self):
+        return f"s3://{self.bucket}/{self.key}"
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self._position = position
+        return self._position
+
+    def _get_range(self, start, end=None):
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+        with storage_timer("get_range", self.name) as stats:
+            response = s3.get_object(
+                Bucket=self.bucket, Key=self.key, Range=byte_range, IfMatch=self.etag
+            )
+            data = response["Body"].read()
+            stats["bytes"] = len(data)
+        return data
+
+    def readinto(self, buffer):
+        if self._position >= self.size or len(buffer) == 0:
+            return 0
+        end = min(self._position + len(buffer), self.size) - 1
+        data = self._get_range(self._position, end)
+        size = len(data)
+        buffer[:size] = data
+        self._position += size
+        return size
+
+    def readall(self):
+        # The default implementation loops over small reads, which would turn into one request per 8KiB
+        if self._position >= self.size:
+            return b""
+        data = self._get_range(self._position)
+        self._position += len(data)
+        return data
+
+
+class StorageCache:
+    """
+    Size-capped, least-recently-used disk cache for remote storage objects.
+
+    Entries are keyed by URL and remember the ETag they were fetched with. Every open revalidates the entry
+    with a conditional GET, so an unchanged object is served from local disk and a rewritten one is fetched
+    again. Recency is tracked through the mtime of the cached files so that it is shared by every process
+    using the same cache directory.
+    """
+
+    def __init__(self, directory, max_bytes, max_object_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _entry_paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return (
+            os.path.join(self.directory, f"{key}.data"),
+            os.path.join(self.directory, f"{key}.etag"),
+        )
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def open(self, url, fetch):
+        """
+        Open `url` from the cache, calling `fetch(etag)` to revalidate or fill the entry.
+
+        `fetch` returns None when the cached ETag is still current, otherwise a tuple of the new ETag, the
+        object size, a function writing the object into a file and a function releasing the request. Returns
+        None if the object can't be cached, in which case the caller should read it from storage directly.
+        """
+        data_path, etag_path = self._entry_paths(url)
+        try:
+            with open(etag_path) as etag_file:
+                cached_etag = etag_file.read()
+        except FileNotFoundError:
+            cached_etag = None
+
+        fetched = fetch(cached_etag)
+        if fetched is None:
+            try:
+                cached_file = open(data_path, "rb")
+                os.utime(data_path)
+                self._count(hit=True)
+                return cached_file
+            except FileNotFoundError:
+                # Evicted between revalidation and open, fetch it again unconditionally
+                fetched = fetch(None)
+
+        self._count(hit=False)
+        etag, size, write, close = fetched
+        if not etag or size is None or size > self.max_object_bytes:
+            close()
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as temp_file:
+                with storage_timer("cache_fill", url) as stats:
+                    write(temp_file)
+                    stats["bytes"] = temp_file.tell()
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+        finally:
+            close()
+        # Drop the old ETag before swapping the data so a reader can never pair stale data with a new ETag
+        try:
+            os.remove(etag_path)
+        except FileNotFoundError:
+            pass
+        os.replace(temp_file.name, data_path)
+        with open(etag_path, "w") as etag_file:
+            etag_file.write(etag)
+
+        cached_file = open(data_path, "rb")
+        self._evict(keep=data_path)
+        return cached_file
+
+    def _evict(self, keep):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".data"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            for stale_path in (path[: -len(".data")] + ".etag", path):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+
+
+storage_cache = StorageCache(
+    directory=settings.STORAGE_CACHE_DIR,
+    max_bytes=settings.STORAGE_CACHE_MAX_BYTES,
+    max_object_bytes=settings.STORAGE_CACHE_MAX_OBJECT_BYTES,
+)
+
+
+def _fetch_s3(bucket, key, etag):
+    kwargs = {"Bucket": bucket, "Key": key}
+    if etag:
+        kwargs["IfNoneMatch"] = etag
+    try:
+        head = s3.head_object(**kwargs)
+    except botocore.exceptions.ClientError as e:
+        if e.response["ResponseMetadata"]["HTTPStatusCode"] == 304:
+            return None
+        raise
+
+    def write(fileobj):
+        # Large objects are fetched as parallel ranged GETs
+        s3.download_fileobj(Bucket=bucket, Key=key, Fileobj=fileobj, Config=download_config)
+
+    return head["ETag"], head["ContentLength"], write, lambda: None
+
+
+def _fetch_http(url, etag):
+    headers = {"If-None-Match": etag} if etag else {}
+    response = requests.get(url, headers=headers, stream=True)
+    if response.status_code == 304:
+        response.close()
+        return None
+    if response.status_code == 404:
+        response.close()
+        raise FileNotFoundError(url)
+    response.raise_for_status()
+    size = response.headers.get("Content-Length")
+    # Let the raw stream undo any transfer encoding so the cached bytes are the object's bytes
+    response.raw.decode_content = True
+    return (
+        response.headers.get("ETag"),
+        int(size) if size is not None else None,
+        lambda fileobj: shutil.copyfileobj(response.raw, fileobj, settings.STORAGE_COPY_CHUNKSIZE),
+        response.close,
+    )
+
+
+def _open_rawfile(path, cache):
     location_info = urlparse(path)
+    scheme = location_info.scheme.lower()
+    use_cache = cache and storage_cache.enabled
 
-    if location_info.scheme.lower() == "file":
+    if scheme == "file":
         raw_file = open(location_info.path, "rb")
-    elif location_info.scheme.lower() == "s3":
+    elif scheme == "s3":
         try:
             file_path = location_info.path.lstrip("/")
-            raw_file = tempfile.TemporaryFile()
-            s3.download_fileobj(
-                Bucket=location_info.netloc, Key=file_path, Fileobj=raw_file
-            )
-            raw_file.seek(0)
+            raw_file = None
+            if use_cache:
+                raw_file = storage_cache.open(
+                    path, functools.partial(_fetch_s3, location_info.netloc, file_path)
+                )
+            if raw_file is None:
+                raw_file = io.BufferedReader(
+                    S3RangeReader(bucket=location_info.netloc, key=file_path),
+                    buffer_size=settings.S3_READ_AHEAD_BYTES,
+                )
         except botocore.exceptions.ClientError as e:
             logging.warn(e)
             raise FileNotFoundError()
+    elif scheme in ("http", "https"):
+        raw_file = None
+        if use_cache:
+            raw_file = storage_cache.open(path, functools.partial(_fetch_http, path))
+        if raw_file is None:
+            # Parquet readers need to seek, so uncached downloads are spooled to disk
+            etag, size, write, close = _fetch_http(path, etag=None)
+            raw_file = tempfile.TemporaryFile()
+            try:
+                write(raw_file)
+            finally:
+                close()
+            raw_file.seek(0)
     else:
         raise RuntimeError("File storage format is unknown")
 
     return raw_file
 
 
+# Suffix of the lightweight reference objects that point a dataset file at its content-addressed blob
+REFERENCE_SUFFIX = ".ref"
+
+
+def get_rawfile_reference(path):
+    """
+    Return the reference stored for `path` (a dict with the `blob` URL, its `sha256` and `size`) or None if the
+    file at `path` is stored directly.
+    """
+    try:
+        reference_file = _open_rawfile(f"{path}{REFERENCE_SUFFIX}", cache=False)
+    except FileNotFoundError:
+        return None
+    with reference_file:
+        return json.load(reference_file)
+
+
+def get_rawfile(path, cache=True):
+    with storage_timer("open", path):
+        try:
+            return _open_rawfile(path, cache)
+        except FileNotFoundError:
+            # Deduplicated uploads are stored once under a content-addressed key with a reference at `path`
+            reference = get_rawfile_reference(path)
+            if reference is None:
+                raise
+            return _open_rawfile(reference["blob"], cache)
+
+
+def _download_object(path, local_path):
+    """Copy the object stored directly at `path` to `local_path`. Raises FileNotFoundError if there is none."""
+    location_info = urlparse(path)
+    if location_info.scheme.lower() == "s3":
+        bucket, key = location_info.netloc, location_info.path.lstrip("/")
+        try:
+            source = None
+            if storage_cache.enabled:
+                source = storage_cache.open(path, functools.partial(_fetch_s3, bucket, key))
+            if source is None:
+                # The cache is off or declined the object (too large): fetch it with parallel ranged GETs
+                s3.download_file(Bucket=bucket, Key=key, Filename=local_path, Config=download_config)
+                return
+        except botocore.exceptions.ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                raise FileNotFoundError(path) from e
+            raise
+    else:
+        source = _open_rawfile(path, cache=True)
+
+    with source, open(local_path, "wb") as local_file:
+        shutil.copyfileobj(source, local_file, settings.STORAGE_COPY_CHUNKSIZE)
+
+
+def download_rawfile(path, local_path):
+    """
+    Copy the file at `path` to `local_path`, for tools that need a file on local disk. S3 objects are served from
+    the disk cache when it holds them, and otherwise fetched with parallel ranged GETs.
+    """
+    with storage_timer("download", path) as stats:
+        try:
+            _download_object(path, local_path)
+        except FileNotFoundError:
+            # Deduplicated uploads are stored once under a content-addressed key with a reference at `path`
+            reference = get_rawfile_reference(path)
+            if reference is None:
+                raise
+            _download_object(reference["blob"], local_path)
+        stats["bytes"] = os.path.getsize(local_path)
+
+
 def put_rawfile(path, fileobj):
     location_info = urlparse(path)
 
+    with storage_timer("put", path) as stats:
+        if location_info.scheme.lower() == "file":
+            if not os.path.isdir(os.path.dirname(location_info.path)):
+                os.makedirs(os.path.dirname(location_info.path), exist_ok=True)
+            with open(location_info.path, "wb") as output_file:
+                shutil.copyfileobj(fileobj, output_file, settings.STORAGE_COPY_CHUNKSIZE)
+                stats["bytes"] = output_file.tell()
+        elif location_info.scheme.lower() == "s3":
+            output_path = location_info.path.lstrip("/")
+            uploaded = [0]
+            s3.upload_fileobj(
+                fileobj,
+                Bucket=location_info.netloc,
+                Key=output_path,
+                Config=upload_config,
+                Callback=lambda size: uploaded.__setitem__(0, uploaded[0] + size),
+            )
+            stats["bytes"] = uploaded[0]
+        else:
+            raise RuntimeError("File storage format is unknown")
+
+
+def rawfile_exists(path):
+    location_info = urlparse(path)
+
+    if location_info.scheme.lower() == "file":
+        return os.path.isfile(location_info.path)
+    elif location_info.scheme.lower() == "s3":
+        try:
+            with storage_timer("exists", path):
+                s3.head_object(Bucket=location_info.netloc, Key=location_info.path.lstrip("/"))
+        except botocore.exceptions.ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                return False
+            raise
+        return True
+    else:
+        raise RuntimeError("File storage format is unknown")
+
+
+def delete_rawfile(path):
+    location_info = urlparse(path)
+
     if location_info.scheme.lower() == "file":
-        if not os.path.isdir(os.path.dirname(location_info.path)):
-            os.makedirs(os.path.dirname(location_info.path), exist_ok=True)
-        with open(location_info.path, "wb") as output_file:
-            output_file.write(fileobj.read())
+        try:
+            os.remove(location_info.path)
+        except FileNotFoundError:
+            pass
     elif location_info.scheme.lower() == "s3":
-        output_path = location_info.path.lstrip("/")
-        s3.put_object(Bucket=location_info.netloc, Key=output_path, Body=fileobj)
+        with storage_timer("delete", path):
+            s3.delete_object(Bucket=location_info.netloc, Key=location_info.path.lstrip("/"))
     else:
         raise RuntimeError("File storage format is unknown")
 
 
-def list_files(path):
+def _iter_s3_listing(bucket, prefix, delimiter=None):
+    """Page through `list_objects_v2`, yielding each page as it arrives."""
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    while True:
+        with storage_timer("list", f"s3://{bucket}/{prefix}"):
+            page = s3.list_objects_v2(**kwargs)
+        yield page
+        if not page.get("IsTruncated"):
+            break
+        kwargs["ContinuationToken"] = page["NextContinuationToken"]
+
+
+def _list_s3_prefix(bucket, prefix):
+    return [
+        s3_object
+        for page in _iter_s3_listing(bucket, prefix)
+        for s3_object in page.get("Contents", [])
+    ]
+
+
+def iter_files(path, concurrency=None):
+    """
+    Lazily yield every file below `path` as a dict with its `name` (relative to `path`), `size` and `etag`.
+
+    S3 listings are paginated with continuation tokens, so there is no cap on the number of keys. When
+    `concurrency` is greater than one, the sub-prefixes directly below `path` are listed in parallel and their
+    results are yielded in prefix order.
+    """
     location_info = urlparse(path)
+    if concurrency is None:
+        concurrency = settings.STORAGE_LIST_CONCURRENCY
+
     if location_info.scheme.lower() == "file":
-        return os.listdir(location_info.path)
+        root = location_info.path
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                yield {
+                    "name": os.path.relpath(file_path, root),
+                    "size": stat.st_size,
+                    "etag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                }
     elif location_info.scheme.lower() == "s3":
-        s3_list = s3.list_objects(
-            Bucket=location_info.netloc, Prefix=location_info.path
-        )
-        s3_contents = s3_list["Contents"]
-        final_file_list = []
-        for x in s3_contents:
-            filename = x["Key"]
-            final_file_list.append(f"{location_info.path}/{filename}")
+        bucket = location_info.netloc
+        prefix = location_info.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+
+        def to_entry(s3_object):
+            return {
+                "name": s3_object["Key"][len(prefix):],
+                "size": s3_object["Size"],
+                "etag": s3_object["ETag"],
+            }
+
+        if concurrency <= 1:
+            for page in _iter_s3_listing(bucket, prefix):
+                for s3_object in page.get("Contents", []):
+                    yield to_entry(s3_object)
+            return
 
-        return final_file_list
+        sub_prefixes = []
+        for page in _iter_s3_listing(bucket, prefix, delimiter="/"):
+            for s3_object in page.get("Contents", []):
+                yield to_entry(s3_object)
+            sub_prefixes.extend(common["Prefix"] for common in page.get("CommonPrefixes", []))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for s3_objects in executor.map(
+                functools.partial(_list_s3_prefix, bucket), sub_prefixes
+            ):
+                for s3_object in s3_objects:
+                    yield to_entry(s3_object)
     else:
         raise RuntimeError("File storage format is unknown")
+
+
+def list_files(path):
+    return [entry["name"] for entry in iter_files(path)]
+
+
+def data_file_url(path):
+    """
+    URL under which a processed file is recorded in a dataset's `data_paths`: S3 objects are referenced by their
+    public https URL, anything else by its storage path.
+    """
+    if path.startswith("s3:"):
+        location_info = urlparse(path)
+        return f"https://{location_info.netloc}.s3.amazonaws.com{location_info.path}"
+    return path